@@ -20,6 +20,11 @@ class Machine(Model):
     id = Column(Integer, primary_key=True)
     name = Column(String(50), nullable=False)
     comment = Column(String(50), nullable=True)
+    # RouterOS API access used by sentynel.py --devices-db
+    ip = Column(IPAddressType, nullable=True)
+    api_port = Column(Integer, nullable=True, default=8728)
+    api_username = Column(String(50), nullable=True)
+    api_password = Column(String(50), nullable=True)
     blackList = relationship("Blacklist", secondary=machine_blacklist_association)
     whiteList = relationship("Whitelist", secondary=machine_whitelist_association)
 
@@ -38,7 +38,7 @@ from sqlalchemy.orm import relationship
 class MachineModelView(ModelView):
     datamodel = SQLAInterface(Machine)
     label_columns = {'Name':'Name'}
-    list_columns = ['name','comment']
+    list_columns = ['name','ip','comment']
 
 class BlackListModelView(ModelView):
     datamodel = SQLAInterface(Blacklist)
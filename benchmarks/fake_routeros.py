@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python
+
+# Lokalni nahrada RouterOS API pro benchmarky - mluvi skutecnym protokolem
+# (slova s delkovym prefixem, vety, .tag), umi login a tu cast
+# /ip/firewall/address-list, kterou pouziva sentynel.py.
+# --latency je doba odezvy site (odpovedi se zpozdi, dalsi prikazy se zpracovavaji hned),
+# --service-time je doba zpracovani jednoho prikazu routerem (prikazy jednoho spojeni jdou po sobe).
+# spusteni: python benchmarks/fake_routeros.py [--port 8728] [--latency 0.002]
+
+import argparse
+import collections
+import heapq
+import ipaddress
+import shlex
+import socket
+import socketserver
+import threading
+import time
+
+from routeros_api.base_api import encode_length, decode_length
+
+
+class Entry:
+    __slots__ = ("id", "list", "address", "timeout", "comment", "expires")
+
+    def __init__(self, id, list, address, timeout=None, comment=None):
+        self.id = id
+        self.list = list
+        self.address = address
+        self.comment = comment
+        self.set_timeout(timeout)
+
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+        self.expires = time.monotonic() + parse_duration(timeout) if timeout else None
+
+    def attributes(self):
+        attrs = {".id": "*{:X}".format(self.id), "list": self.list, "address": self.address,
+                 "dynamic": "true" if self.timeout else "false", "disabled": "false"}
+        if self.timeout:
+            attrs["timeout"] = self.timeout
+        if self.comment is not None:
+            attrs["comment"] = self.comment
+        return attrs
+
+
+def parse_duration(value):
+    units = {"w": 604800, "d": 86400, "h": 3600, "m": 60, "s": 1}
+    if value.isdigit():
+        return int(value)
+    total, number = 0, ""
+    for char in value:
+        if char.isdigit():
+            number += char
+        elif char in units and number:
+            total += int(number) * units[char]
+            number = ""
+        else:
+            raise ValueError(value)
+    return total
+
+
+def compare_key(value):
+    try:
+        return 0, int(ipaddress.ip_network(value, strict=False).network_address)
+    except ValueError:
+        return 1, value
+
+
+class RouterState:
+    def __init__(self, latency=0.0, latencies=None, cpu_load=5, service_time=0.0):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.by_key = {}
+        self.files = {}
+        self.next_id = 1
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.service_time = service_time
+        self.cpu_load = cpu_load
+        self.calls = {}
+        self.expiries = []
+
+    def expire(self):
+        now = time.monotonic()
+        while self.expiries and self.expiries[0][0] <= now:
+            expires, entry_id = heapq.heappop(self.expiries)
+            entry = self.entries.get(entry_id)
+            if entry is not None and entry.expires is not None and entry.expires <= now:
+                self._delete(entry)
+
+    def _delete(self, entry):
+        del self.entries[entry.id]
+        del self.by_key[(entry.list, entry.address)]
+
+    def add(self, list_name, address, timeout=None, comment=None):
+        address = str(ipaddress.ip_network(address, strict=False)).replace("/32", "")
+        if (list_name, address) in self.by_key:
+            raise CommandError("failure: already have such entry")
+        entry = Entry(self.next_id, list_name, address, timeout, comment)
+        self.next_id += 1
+        self.entries[entry.id] = entry
+        self.by_key[(list_name, address)] = entry
+        self.schedule(entry)
+        return entry
+
+    def schedule(self, entry):
+        if entry.expires is not None:
+            heapq.heappush(self.expiries, (entry.expires, entry.id))
+
+
+class CommandError(Exception):
+    pass
+
+
+def parse_ids(value):
+    ids = []
+    for item in value.split(","):
+        if not item.startswith("*"):
+            raise CommandError("no such item")
+        ids.append(int(item[1:], 16))
+    return ids
+
+
+def evaluate_queries(queries, attrs):
+    # zasobnikovy automat dle https://wiki.mikrotik.com/wiki/Manual:API#Queries
+    stack = []
+    for word in queries:
+        if word.startswith("?#"):
+            for op in word[2:]:
+                if op == "!":
+                    stack.append(not stack.pop())
+                elif op in "&|":
+                    right, left = stack.pop(), stack.pop()
+                    stack.append(left and right if op == "&" else left or right)
+                elif op == ".":
+                    stack.append(stack[-1])
+            continue
+        body = word[1:]
+        if body.startswith("-"):
+            stack.append(body[1:] not in attrs)
+            continue
+        if "=" not in body:
+            stack.append(body in attrs)
+            continue
+        key, value = body.split("=", 1)
+        if key.startswith("<") or key.startswith(">"):
+            op, key = key[0], key[1:]
+            if key not in attrs:
+                stack.append(False)
+                continue
+            left, right = compare_key(attrs[key]), compare_key(value)
+            stack.append(left < right if op == "<" else left > right)
+        else:
+            stack.append(attrs.get(key) == value)
+    return all(stack)
+
+
+class ApiHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        # replies are single writes, Nagle would only hold back the reply behind an unacknowledged one
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.state = self.server.state
+        self.logged_in = False
+        self.buffer = b""
+        self.replies = collections.deque()  # (due, data), sent by a separate thread to simulate the round trip
+        self.replies_ready = threading.Condition()
+        self.last_due = 0.0
+        self.sender = None
+        if self.state.latency or self.state.latencies:
+            self.sender = threading.Thread(target=self.send_replies, daemon=True)
+            self.sender.start()
+
+    def finish(self):
+        if self.sender is not None:
+            self.send(None, 0.0)
+            self.sender.join()
+
+    def send(self, data, delay):
+        if self.sender is None:
+            self.request.sendall(data)
+            return
+        with self.replies_ready:
+            # replies leave in command order like on the router, a shorter delay can't overtake a longer one
+            self.last_due = max(time.monotonic() + delay, self.last_due)
+            self.replies.append((self.last_due, data))
+            self.replies_ready.notify()
+
+    def send_replies(self):
+        while True:
+            with self.replies_ready:
+                while not self.replies:
+                    self.replies_ready.wait()
+                due, data = self.replies.popleft()
+            if data is None:
+                return
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.request.sendall(data)
+            except OSError:
+                pass
+
+    def read(self, length):
+        while len(self.buffer) < length:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                raise ConnectionError("client closed")
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:length], self.buffer[length:]
+        return data
+
+    def read_sentence(self):
+        words = []
+        while True:
+            length = decode_length(self.read)
+            if length == 0:
+                return words
+            words.append(self.read(length).decode("utf-8", "replace"))
+
+    def write_sentence(self, out, words):
+        for word in words:
+            data = word.encode()
+            out.append(encode_length(len(data)) + data)
+        out.append(b"\x00")
+
+    def handle(self):
+        try:
+            while True:
+                sentence = self.read_sentence()
+                if not sentence:
+                    continue
+                out = []
+                delay = self.state.latencies.get(sentence[0].rsplit("/", 1)[-1], self.state.latency)
+                keep_open = self.dispatch(sentence, out, delay)
+                self.send(b"".join(out), delay)
+                if not keep_open:
+                    return
+        except (ConnectionError, OSError):
+            pass
+
+    def dispatch(self, sentence, out, delay=0.0):
+        command, tag, args, queries = sentence[0], None, {}, []
+        for word in sentence[1:]:
+            if word.startswith(".tag="):
+                tag = word[5:]
+            elif word.startswith("="):
+                key, _, value = word[1:].partition("=")
+                args[key] = value
+            elif word.startswith("?"):
+                queries.append(word)
+        suffix = [".tag=" + tag] if tag is not None else []
+        if self.state.service_time:
+            time.sleep(self.state.service_time)
+        if command == "/quit":
+            self.write_sentence(out, ["!fatal", "session terminated on request"] + suffix)
+            return False
+        if command == "/login":
+            self.logged_in = True
+            self.write_sentence(out, ["!done"] + suffix)
+            return True
+        if not self.logged_in:
+            self.write_sentence(out, ["!fatal", "not logged in"] + suffix)
+            return False
+        with self.state.lock:
+            self.state.calls[command] = self.state.calls.get(command, 0) + 1
+            try:
+                replies, ret = self.execute(command, args, queries)
+            except CommandError as e:
+                self.write_sentence(out, ["!trap", "=message=" + str(e)] + suffix)
+                self.write_sentence(out, ["!done"] + suffix)
+                return True
+        for attrs in replies:
+            self.write_sentence(out, ["!re"] + ["={}={}".format(k, v) for k, v in attrs.items()] + suffix)
+            if len(out) >= 65536:
+                # long listings go out in pieces instead of one huge buffer
+                self.send(b"".join(out), delay)
+                del out[:]
+        done = ["!done"] + (["=ret=" + ret] if ret is not None else [])
+        self.write_sentence(out, done + suffix)
+        return True
+
+    def execute(self, command, args, queries):
+        state = self.state
+        if command == "/system/identity/print":
+            return [{"name": "fake-routeros"}], None
+        if command == "/system/resource/print":
+            return [{"cpu-load": str(state.cpu_load), "version": "7.12 (fake)"}], None
+        if command == "/file/add" or command == "/file/set":
+            state.files[args.get("name", args.get(".id"))] = args.get("contents", "")
+            return [], None
+        if command == "/file/remove":
+            state.files.pop(args.get(".id", args.get("numbers")), None)
+            return [], None
+        if command == "/import":
+            return [], self.import_script(args.get("file-name", ""))
+        if not command.startswith("/ip/firewall/address-list/"):
+            raise CommandError("no such command prefix")
+        state.expire()
+        action = command.rsplit("/", 1)[-1]
+        if action == "add":
+            if "list" not in args or "address" not in args:
+                raise CommandError("failure: missing list or address")
+            try:
+                entry = state.add(args["list"], args["address"], args.get("timeout"), args.get("comment"))
+            except ValueError:
+                raise CommandError("invalid value for argument address")
+            return [], "*{:X}".format(entry.id)
+        if action == "remove":
+            ids = parse_ids(args.get(".id", args.get("numbers", "")))
+            for entry_id in ids:
+                if entry_id not in state.entries:
+                    raise CommandError("no such item")
+            for entry_id in ids:
+                state._delete(state.entries[entry_id])
+            return [], None
+        if action == "set":
+            ids = parse_ids(args.get(".id", args.get("numbers", "")))
+            for entry_id in ids:
+                if entry_id not in state.entries:
+                    raise CommandError("no such item")
+            for entry_id in ids:
+                if "timeout" in args:
+                    state.entries[entry_id].set_timeout(args["timeout"])
+                    state.schedule(state.entries[entry_id])
+                if "comment" in args:
+                    state.entries[entry_id].comment = args["comment"]
+            return [], None
+        if action == "print":
+            matched = self.lookup(queries)
+            if matched is None:
+                matched = [e.attributes() for e in state.entries.values()]
+                if queries:
+                    matched = [a for a in matched if evaluate_queries(queries, a)]
+            if "count-only" in args:
+                return [], str(len(matched))
+            if ".proplist" in args:
+                props = args[".proplist"].split(",")
+                matched = [{k: a[k] for k in props if k in a} for a in matched]
+            return matched, None
+        raise CommandError("no such command")
+
+    def lookup(self, queries):
+        # "?list=...?address=..." is answered from the index like the router does, not by scanning every entry
+        if len(queries) != 2 or any(not word.startswith(("?list=", "?address=")) for word in queries):
+            return None
+        values = dict(word[1:].split("=", 1) for word in queries)
+        if len(values) != 2:
+            return None
+        entry = self.state.by_key.get((values["list"], values["address"]))
+        return [entry.attributes()] if entry is not None else []
+
+    def import_script(self, name):
+        if name not in self.state.files:
+            raise CommandError("failure: file not found")
+        current_path = ""
+        for line in self.state.files[name].splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("/"):
+                current_path = line
+                continue
+            if current_path != "/ip firewall address-list" or not line.startswith("add "):
+                raise CommandError("failure: unsupported script line")
+            args = dict(item.split("=", 1) for item in shlex.split(line[4:]))
+            try:
+                self.state.add(args["list"], args["address"], args.get("timeout"), args.get("comment"))
+            except CommandError:
+                pass
+        return None
+
+
+class FakeRouterOs(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, latencies=None, service_time=0.0):
+        super().__init__(address, ApiHandler)
+        self.state = RouterState(latency, latencies, service_time=service_time)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake RouterOS API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8728)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Round-trip time in seconds added to every reply, pipelined commands overlap')
+    parser.add_argument('--service-time', type=float, default=0.0,
+                        help='Seconds the router spends on every API command, commands of a session queue up')
+    args = parser.parse_args()
+    server = FakeRouterOs((args.host, args.port), args.latency, service_time=args.service_time)
+    print("Fake RouterOS API listening on {}:{}".format(args.host, server.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
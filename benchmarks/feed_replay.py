@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python
+
+# Lokalni dynfw server pro zatezove testy: CURVE PUB socket, ktery prehraje zaznam z sentynel.py --record
+# (nebo generuje LIST + delta zpravy) N-krat rychleji, volitelne s vynechanymi serialy a restarty serveru.
+# Klient se pripoji s -s 127.0.0.1 -p <port> -c <keys>/server.key, jeho --metrics-port pak ukaze,
+# jakou rychlost delt jeste stiha zapisovat.
+# spusteni: python benchmarks/feed_replay.py [--capture zaznam.rec] [--speed 10] [--rate 1000] [--drop-every 5000]
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+import msgpack
+import zmq
+import zmq.auth
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sentynel import TOPIC_DYNFW_DELTA, TOPIC_DYNFW_LIST, int_to_ip, read_recording  # noqa: E402
+
+logger = logging.getLogger("feed_replay")
+
+KEYS_DIR_DEFAULT = "./var/replay"
+#kolik zprav se posle, nez se znovu zkontroluji odbery a casovani
+SEND_SLICE = 100
+#jak casto (v sekundach) se vypisuje dosazena rychlost
+REPORT_INTERVAL = 1
+
+
+class FeedServer:
+    # XPUB instead of PUB shows the subscriptions, so a LIST can be sent as soon as a client asks for it
+    def __init__(self, context, port, keys_dir):
+        self.context = context
+        self.port = port
+        self.public_file, self.secret_file = server_certificate(keys_dir)
+        self.socket = None
+        self.sent = 0
+        self.dropped = 0
+        self.restarts = 0
+        self.bind()
+
+    def bind(self):
+        self.socket = self.context.socket(zmq.XPUB)
+        public, secret = zmq.auth.load_certificate(self.secret_file)
+        self.socket.curve_secretkey = secret
+        self.socket.curve_publickey = public
+        self.socket.curve_server = True
+        self.socket.bind("tcp://*:{}".format(self.port))
+
+    def restart(self):
+        # connections are dropped, the clients reconnect on their own
+        self.socket.close(linger=0)
+        self.restarts += 1
+        self.bind()
+        logger.info("Server restarted")
+
+    def subscriptions(self, timeout=0):
+        # topics newly subscribed by a client
+        topics = []
+        while self.socket.poll(timeout):
+            message = self.socket.recv()
+            if message[:1] == b"\x01":
+                topics.append(message[1:].decode("utf-8", "replace"))
+            timeout = 0
+        return topics
+
+    def wait_for_client(self):
+        logger.info("Waiting for a client: -s 127.0.0.1 -p %d -c %s", self.port, self.public_file)
+        while TOPIC_DYNFW_LIST not in self.subscriptions(1000):
+            pass
+
+    def send(self, frames):
+        self.socket.send_multipart(frames)
+        self.sent += 1
+
+
+def server_certificate(keys_dir):
+    public_file = os.path.join(keys_dir, "server.key")
+    secret_file = os.path.join(keys_dir, "server.key_secret")
+    if not os.path.exists(secret_file):
+        os.makedirs(keys_dir, exist_ok=True)
+        zmq.auth.create_certificates(keys_dir, "server")
+    return public_file, secret_file
+
+
+class Pacer:
+    # sleeps so that messages go out at `rate` per second, reports the rate reached
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.count = 0
+        self.reported_at = self.started
+        self.reported_count = 0
+
+    def wait(self, count=1):
+        self.count += count
+        if self.rate > 0:
+            ahead = self.count / self.rate - (time.monotonic() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+        now = time.monotonic()
+        if now - self.reported_at >= REPORT_INTERVAL:
+            logger.info("%d messages, %.0f msg/s", self.count, (self.count - self.reported_count) /
+                        (now - self.reported_at))
+            self.reported_at, self.reported_count = now, self.count
+
+
+class SyntheticFeed:
+    # blocked addresses change by one delta at a time, as many blocked as unblocked on average
+    def __init__(self, list_size, seed):
+        self.random = random.Random(seed)
+        self.blocked = []
+        self.positions = {}
+        self.serial = 1
+        for _ in range(list_size):
+            self._block()
+
+    def _block(self):
+        while True:
+            address = int_to_ip(self.random.getrandbits(32))
+            if address not in self.positions:
+                break
+        self.positions[address] = len(self.blocked)
+        self.blocked.append(address)
+        return address
+
+    def _unblock(self):
+        position = self.random.randrange(len(self.blocked))
+        address = self.blocked[position]
+        last = self.blocked.pop()
+        if last != address:
+            self.blocked[position] = last
+            self.positions[last] = position
+        del self.positions[address]
+        return address
+
+    def restart(self):
+        # a restarted server counts serials from the beginning again
+        self.serial = 1
+
+    def list_message(self):
+        return [TOPIC_DYNFW_LIST.encode("utf-8"), msgpack.packb({"serial": self.serial, "list": self.blocked})]
+
+    def delta_message(self):
+        self.serial += 1
+        if self.blocked and self.random.random() < 0.5:
+            delta, address = "negative", self._unblock()
+        else:
+            delta, address = "positive", self._block()
+        return [TOPIC_DYNFW_DELTA.encode("utf-8"),
+                msgpack.packb({"serial": self.serial, "delta": delta, "ip": address})]
+
+
+def replay_synthetic(server, args):
+    feed = SyntheticFeed(args.list_size, args.seed)
+    pacer = Pacer(args.rate * args.speed)
+    list_sent_at = 0.0
+    restarted_at = time.monotonic()
+    deltas = 0
+    while args.count <= 0 or deltas < args.count:
+        now = time.monotonic()
+        if args.restart_every and now - restarted_at >= args.restart_every:
+            server.restart()
+            feed.restart()
+            restarted_at = now
+            list_sent_at = 0.0
+        if TOPIC_DYNFW_LIST in server.subscriptions() or now - list_sent_at >= args.list_interval:
+            server.send(feed.list_message())
+            list_sent_at = now
+        for _ in range(SEND_SLICE):
+            message = feed.delta_message()
+            deltas += 1
+            if args.drop_every and not deltas % args.drop_every:
+                server.dropped += 1  # injected serial gap
+            else:
+                server.send(message)
+            pacer.wait()
+
+
+def replay_capture(server, args):
+    for loop in range(args.loops):
+        started = time.monotonic()
+        deltas = 0
+        for offset, frames in read_recording(args.capture):
+            ahead = offset / args.speed - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+            server.subscriptions()
+            if frames[0] == TOPIC_DYNFW_DELTA.encode("utf-8"):
+                deltas += 1
+                if args.drop_every and not deltas % args.drop_every:
+                    server.dropped += 1
+                    continue
+            server.send(frames)
+            if args.restart_every and time.monotonic() - started >= args.restart_every * (server.restarts + 1):
+                server.restart()
+        logger.info("Capture replayed (%d/%d), %.1f s", loop + 1, args.loops, time.monotonic() - started)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay or generate a dynfw feed for load testing')
+    parser.add_argument('-p', '--port', type=int, default=7087,
+                        help='Port to publish on')
+    parser.add_argument('--keys', default=KEYS_DIR_DEFAULT,
+                        help='Directory with the CURVE server certificate, created when missing')
+    parser.add_argument('--capture',
+                        help='Recording made with sentynel.py --record, synthetic feed when not given')
+    parser.add_argument('--loops', type=int, default=1,
+                        help='How many times the capture is replayed')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Rate multiplier: capture timing divided, synthetic --rate multiplied by this')
+    parser.add_argument('--rate', type=float, default=100.0,
+                        help='Synthetic deltas per second (0 = as fast as possible)')
+    parser.add_argument('--count', type=int, default=0,
+                        help='Stop after this many synthetic deltas (0 = never)')
+    parser.add_argument('--list-size', type=int, default=100000,
+                        help='Addresses in the synthetic list')
+    parser.add_argument('--list-interval', type=float, default=60.0,
+                        help='Seconds between synthetic LIST messages (also sent on every new subscription)')
+    parser.add_argument('--drop-every', type=int, default=0,
+                        help='Leave out every Nth delta to inject a serial gap (0 = never)')
+    parser.add_argument('--restart-every', type=float, default=0.0,
+                        help='Restart the server every N seconds, synthetic serials start over (0 = never)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seed of the synthetic feed')
+    parser.add_argument('--no-wait', action='store_true',
+                        help="Don't wait for a client to subscribe before starting")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    context = zmq.Context()
+    server = FeedServer(context, args.port, args.keys)
+    if not args.no_wait:
+        server.wait_for_client()
+    started = time.monotonic()
+    try:
+        if args.capture:
+            replay_capture(server, args)
+        else:
+            replay_synthetic(server, args)
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.monotonic() - started
+    logger.info("Sent %d messages in %.1f s (%.0f msg/s), %d deltas left out, %d restarts", server.sent, elapsed,
+                server.sent / elapsed if elapsed else 0.0, server.dropped, server.restarts)
+    server.socket.close(linger=1000)
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python
+
+# Pametova narocnost sledovanych adres: puvodni reprezentace (set retezcu, prikazy jako retezce,
+# index jako dict) proti zabalenym 32bitovym cislum v sentynel.py.
+# spusteni: python benchmarks/memory.py [pocet ...]
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sentynel import AddressIndex, OP_ADD, PackedAddressSet, PendingOps, int_to_ip  # noqa: E402
+
+LIST_NAME = 'dynfw-blacklist'
+SIZES = (100000, 1000000)
+
+
+def addresses(count):
+    # pseudo-random spread over the IPv4 space, same for every run
+    return [(i * 2654435761) & 0xFFFFFFFF for i in range(1, count + 1)]
+
+
+def build_strings(values):
+    ips = [int_to_ip(value) for value in values]
+    tracked = set(ips)
+    commands = ['add {} {}\n'.format(LIST_NAME, ip) for ip in ips]
+    index = {(LIST_NAME, ip): '*{:X}'.format(i) for i, ip in enumerate(ips, 1)}
+    return tracked, commands, index
+
+
+def build_packed(values):
+    tracked = PackedAddressSet()
+    tracked.values.extend(sorted(set(values)))
+    commands = PendingOps()
+    for value in values:
+        commands.append(OP_ADD, value)
+    index = AddressIndex()
+    for i, value in enumerate(values, 1):
+        index.add(LIST_NAME, value, '*{:X}'.format(i))
+    return tracked, commands, index
+
+
+def measure(build, values):
+    tracemalloc.start()
+    result = build(values)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print("{:>10} {:>14} {:>14} {:>7}".format("addresses", "strings [MB]", "packed [MB]", "ratio"))
+    for count in sizes:
+        values = addresses(count)
+        before = measure(build_strings, values)
+        after = measure(build_packed, values)
+        print("{:>10} {:>14.1f} {:>14.1f} {:>6.1f}x".format(count, before / 2 ** 20, after / 2 ** 20, before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python
+
+# Rychlost zapisu do MikroTiku proti lokalni nahrade RouterOS API (fake_routeros.py): pridani, odebrani podle .id,
+# odebrani podle adresy, vypis celeho listu, delta zpravy a srovnani s LIST zpravou pro 10k/100k/1M adres.
+# Vysledky se zapisuji jako JSON, aby bylo mozne porovnat behy pred a po zmene Ipset/DynfwList.
+# spusteni: python benchmarks/routeros.py [--sizes 10000 100000] [--latency 0.002] [--output vysledky.json]
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+import msgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sentynel  # noqa: E402
+from fake_routeros import FakeRouterOs  # noqa: E402
+from memory import addresses  # noqa: E402
+from sentynel import DynfwList, Ipset, ListMessage, RouterConnection, int_to_ip  # noqa: E402
+
+LIST_NAME = 'dynfw-benchmark'
+SIZES = (10000, 100000, 1000000)
+#kolik adres se odebere podle adresy (kazda stoji jeden print navic)
+BY_ADDRESS_LIMIT = 10000
+#jaka cast listu se zmeni mezi dvema LIST zpravami, resp. kolik delta zprav se posle
+CHURN = 0.1
+
+
+class NullSocket:
+    # DynfwList only (un)subscribes topics
+    def setsockopt(self, option, value):
+        pass
+
+
+def timed(results, operation, entries, count, func, *args):
+    # the client prints every commit and removal, keep that out of the results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        value = func(*args)
+        seconds = time.perf_counter() - started
+    results.append({
+        "operation": operation,
+        "entries": entries,
+        "count": count,
+        "seconds": round(seconds, 6),
+        "per_second": round(count / seconds, 1) if seconds else None,
+    })
+    logging.info("%8d entries  %-18s %8d ops  %9.3f s  %10.1f ops/s", entries, operation, count, seconds,
+                 count / seconds if seconds else 0.0)
+    return value
+
+
+def add_all(ipset, values):
+    for value in values:
+        ipset.add_ip(value)
+    return ipset.commit()
+
+
+def remove_all(ipset, values):
+    for value in values:
+        ipset.del_ip(value)
+    return ipset.commit()
+
+
+def apply_deltas(dynfw_list, deltas):
+    for delta in deltas:
+        dynfw_list.handle_delta(delta)
+    dynfw_list.batcher.flush()
+
+
+def run_size(count, args):
+    results = []
+    server = FakeRouterOs(latency=args.latency, service_time=args.service_time).start()
+    router = RouterConnection('127.0.0.1', 'admin', 'admin', server.port)
+    try:
+        values = addresses(count)
+        ipset = Ipset(LIST_NAME, router, max_in_flight=args.max_in_flight)
+        timed(results, "add", count, count, add_all, ipset, values)
+        timed(results, "list", count, count, router.call, ipset.index.load, LIST_NAME)
+
+        # next LIST drops CHURN of the addresses and brings as many new ones
+        churn = max(1, int(count * CHURN))
+        wanted = values[churn:] + addresses(count + churn)[count:]
+        data = msgpack.packb({"serial": 1, "list": [int_to_ip(value) for value in wanted]})
+        dynfw_list = DynfwList(NullSocket(), LIST_NAME, router, ipset=ipset, batch_window=args.batch_window)
+        message = ListMessage(data)
+        timed(results, "reconcile", count, 2 * churn, dynfw_list.handle_list, message)
+
+        # as many new addresses blocked as old ones unblocked, one by one
+        deltas = []
+        for blocked, unblocked in zip(addresses(count + 2 * churn)[count + churn:], wanted):
+            deltas.append({"serial": 2 + len(deltas), "delta": "positive", "ip": int_to_ip(blocked)})
+            deltas.append({"serial": 2 + len(deltas), "delta": "negative", "ip": int_to_ip(unblocked)})
+        timed(results, "delta", count, len(deltas), apply_deltas, dynfw_list, deltas)
+
+        current = list(ipset.addresses)
+        by_id = current[:len(current) // 2]
+        timed(results, "remove_by_id", count, len(by_id), remove_all, ipset, by_id)
+
+        # a fresh Ipset doesn't know the .ids, every removal has to look the entry up first
+        by_address = current[len(current) // 2:][:args.by_address_limit]
+        lookup = Ipset(LIST_NAME, router, max_in_flight=args.max_in_flight)
+        for value in by_address:
+            lookup.addresses.add(value)
+        timed(results, "remove_by_address", count, len(by_address), remove_all, lookup, by_address)
+    finally:
+        router.close()
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark address-list operations against a fake RouterOS API')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='Address-list sizes to benchmark')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Round-trip time in seconds simulated by the fake router')
+    parser.add_argument('--service-time', type=float, default=0.0,
+                        help='Seconds the fake router spends on every API command')
+    parser.add_argument('--max-in-flight', type=int, default=sentynel.MAX_IN_FLIGHT_DEFAULT,
+                        help='Pipelined commands waiting for a reply (1 = sequential)')
+    parser.add_argument('--batch-window', type=float, default=sentynel.DELTA_BATCH_WINDOW_DEFAULT,
+                        help='Delta batch window in seconds')
+    parser.add_argument('--by-address-limit', type=int, default=BY_ADDRESS_LIMIT,
+                        help='At most this many addresses are removed by address')
+    parser.add_argument('--output', default='-',
+                        help='File for the JSON results (- for standard output)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    logging.getLogger("sentinel_dynfw_client").setLevel(logging.ERROR)
+    report = {
+        "benchmark": "routeros",
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": sentynel.numpy is not None,
+        "latency": args.latency,
+        "service_time": args.service_time,
+        "max_in_flight": args.max_in_flight,
+        "batch_window": args.batch_window,
+        "results": [],
+    }
+    for count in args.sizes:
+        report["results"].extend(run_size(count, args))
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
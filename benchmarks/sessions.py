@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python
+
+# Rychlost zapisu do MikroTiku podle poctu soubeznych API spojeni (--writer-sessions) proti lokalni nahrade
+# RouterOS API (fake_routeros.py). Kazde spojeni zpracovava prikazy postupne (--service-time), jako RouterOS,
+# takze vice spojeni muze zapisovat rychleji, dokud nestaci klient nebo router.
+# spusteni: python benchmarks/sessions.py [--sessions 1 2 4 8] [--count 20000] [--service-time 0.0005]
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import sentynel  # noqa: E402
+from fake_routeros import FakeRouterOs  # noqa: E402
+from memory import addresses  # noqa: E402
+from routeros import LIST_NAME, add_all, remove_all, timed  # noqa: E402
+from sentynel import Ipset, RouterConnection  # noqa: E402
+
+SESSIONS = (1, 2, 4, 8)
+COUNT = 20000
+#kolik sekund stravi nahrada routeru nad jednim prikazem jednoho spojeni
+SERVICE_TIME = 0.0005
+
+
+def run_sessions(sessions, args):
+    results = []
+    server = FakeRouterOs(latency=args.latency, service_time=args.service_time).start()
+    router = RouterConnection('127.0.0.1', 'admin', 'admin', server.port, sessions=sessions)
+    try:
+        values = addresses(args.count)
+        ipset = Ipset(LIST_NAME, router, max_in_flight=args.max_in_flight, writer_sessions=sessions)
+        timed(results, "add", args.count, args.count, add_all, ipset, values)
+        timed(results, "remove_by_id", args.count, args.count, remove_all, ipset, list(ipset.addresses))
+    finally:
+        router.close()
+        server.shutdown()
+        server.server_close()
+    for result in results:
+        result["sessions"] = sessions
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark address-list writes over K API sessions')
+    parser.add_argument('--sessions', type=int, nargs='+', default=SESSIONS,
+                        help='Numbers of writer sessions to compare')
+    parser.add_argument('--count', type=int, default=COUNT,
+                        help='Addresses added and removed again')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Round-trip time in seconds simulated by the fake router')
+    parser.add_argument('--service-time', type=float, default=SERVICE_TIME,
+                        help='Seconds the fake router spends on every API command of a session')
+    parser.add_argument('--max-in-flight', type=int, default=sentynel.MAX_IN_FLIGHT_DEFAULT,
+                        help='Pipelined commands waiting for a reply, per session')
+    parser.add_argument('--output', default='-',
+                        help='File for the JSON results (- for standard output)')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    logging.getLogger("sentinel_dynfw_client").setLevel(logging.ERROR)
+    report = {
+        "benchmark": "sessions",
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "latency": args.latency,
+        "service_time": args.service_time,
+        "max_in_flight": args.max_in_flight,
+        "results": [],
+    }
+    for sessions in args.sessions:
+        logging.info("%d writer sessions", sessions)
+        report["results"].extend(run_sessions(sessions, args))
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,22 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/python
 
-import routeros_api
-ip4='10.57.10.111'
-connection = routeros_api.RouterOsApiPool(ip4, username='admin', password='admin', port=8728, plaintext_login=True )
-api = connection.get_api()
-list_queues = api.get_resource('/ip/firewall/address-list')
+import sys
+import logging
+from sentynel import Ipset, RouterConnection, MAX_IN_FLIGHT_DEFAULT
 
-pole=list_queues.get()
-for prvek in pole:
-    print(prvek)
-    list_queues.remove(id=prvek['id'])
+# smaze jen zadany address-list (ostatni listy na MikroTiku zustanou), po davkach .id jednim prikazem remove
+# spusteni: python delete.py [address-list]
+ip4='10.57.10.111'
+listName = sys.argv[1] if len(sys.argv) > 1 else 'turris-sn-dynfw-block'
 
-    print(id)
-connection.disconnect()
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+router = RouterConnection(ip4, 'admin', 'admin', 8728)
+ipset = Ipset(listName, router, max_in_flight=MAX_IN_FLIGHT_DEFAULT)
+ipset.delete_all_addresses()
 
 # otestovat rychlost zápisu cca 10K ip adress
 # mazání přes ID - otestovat 10K
 # Otestovat rychlost výpisu 10k záznamů
 
-
-
-connection.disconnect()
+router.close()
@@ -3,6 +3,7 @@
 
 import routeros_api
 from random import randint
+from sentynel import AddressIndex
 # zdroj https://github.com/socialwifi/RouterOS-api/blob/master/README.md
 
 connection = routeros_api.RouterOsApiPool('192.168.0.222', username='admin', password='admin', port=8728, plaintext_login=True )
@@ -13,20 +14,24 @@ list_queues = api.get_resource('/ip/firewall/address-list')
 #print(list_queues.get())
 
 #smazani adresy
-print("zadej ip: ")
-ipToDelete = input()
-i = 0
-
-
-pole=list_queues.get()
-for prvek in pole:
-    if prvek['address'] == ipToDelete:
+print("zadej address-list: ")
+listName = input()
+
+# nacte se jen zadany address-list (jen .id a adresy, po radcich), dal se maze primo podle .id
+index = AddressIndex()
+index.load(api, listName)
+while True:
+    print("zadej ip (prazdne = konec): ")
+    ipToDelete = input()
+    if not ipToDelete:
         break
-    i+= 1
-print(list_queues.get()[i]['id'])
-print(list_queues.get()[i]['address'])
-idToDelete = list_queues.get()[i]['id']
-list_queues.remove(id=idToDelete)
+    idToDelete = index.pop(listName, ipToDelete)
+    if idToDelete is None:
+        print("ip {} neni v address-listu {}".format(ipToDelete, listName))
+        continue
+    print(idToDelete)
+    print(ipToDelete)
+    list_queues.remove(id=idToDelete)
 
 
 
@@ -38,4 +43,4 @@ list_queues.remove(id=idToDelete)
 
 
 
-connection.disconnect()
\ No newline at end of file
+connection.disconnect()
@@ -1,11 +1,28 @@
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import ftplib
+import hashlib
+import heapq
+import http.server
+import io
+import json
 import logging
+import mmap
 import os
+import random
+import socket
+import sqlite3
+import struct
 import subprocess
 import sys
 import re
 import time
 import urllib.request
+import zlib
 import msgpack
 import zmq
 import routeros_api
@@ -15,6 +32,11 @@ import time
 import queue
 import threading
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # LIST messages are validated in pure Python
+
 logger = logging.getLogger("sentinel_dynfw_client")
 #nastavte IP MikroTiku
 ip4 = '192.168.0.222'
@@ -22,8 +44,103 @@ ip4 = '192.168.0.222'
 username = 'admin'
 #nastavte heslo MikroTiku
 password = 'admin'
+#nastavte API port MikroTiku
+api_port = 8728
+#nastavte pocet soubeznych API spojeni na MikroTik
+ROUTER_SESSIONS_DEFAULT = 1
+#kolika API spojenimi zaroven se zapisuji zmeny address-listu (rozdelene podle adresy)
+WRITER_SESSIONS_DEFAULT = 1
+#po kolika sekundach necinnosti se spojeni pred pouzitim overi
+ROUTER_HEALTH_CHECK_INTERVAL = 30
 #nastavte počet přijmutých pokynu MQTT, před resetem routeru
 MISSING_UPDATE_CNT_LIMIT = 10000
+#jak dlouho (v sekundach) se ceka na chybejici delta zpravu, nez se znovu nacte cely list
+SERIAL_GAP_TIMEOUT_DEFAULT = 10
+#jak dlouho (v sekundach) se sbiraji delta zpravy, nez se odeslou na MikroTik najednou
+DELTA_BATCH_WINDOW_DEFAULT = 0.5
+#maximalni pocet adres v jedne davce delta zprav
+DELTA_BATCH_SIZE_DEFAULT = 1000
+#kolik API prikazu smi v rezimu pipelined cekat na odpoved zaroven
+MAX_IN_FLIGHT_DEFAULT = 64
+#v rezimu adaptive: nejmensi pocet soubeznych API prikazu, na ktery regulator klesne
+MIN_IN_FLIGHT_DEFAULT = 1
+#v rezimu adaptive: nad jakou zatez CPU MikroTiku (v %) se zapis zpomali (0 = zatez necist)
+CPU_LIMIT_DEFAULT = 0
+#jak casto (v sekundach) se cte zatez CPU MikroTiku
+CPU_POLL_INTERVAL = 5
+#kolikrat smi odezva prikazu prekrocit nejkratsi namerenou odezvu, nez se zapis zpomali
+WRITE_LATENCY_TOLERANCE = 2.0
+#k tomu pevna rezerva (v sekundach), aby kolisani odezvy v lokalni siti zapis nebrzdilo
+WRITE_LATENCY_SLACK = 0.005
+#na jakou cast se pocet soubeznych prikazu snizi pri pretizeni
+WRITE_DECREASE_FACTOR = 0.5
+#jak casto (v sekundach) se do logu vypisuji statistiky
+STATS_LOG_INTERVAL = 60
+#jak dlouho (v ms) se ceka na zpravu, nez se vypise, ze nic neprislo
+POLL_TIMEOUT = 100000
+#jak casto (v ms) prijimaci vlakno kontroluje zmeny odberu a ukonceni
+RECEIVER_POLL_INTERVAL = 200
+#jak dlouho (v ms) zapisovaci vlakno ceka na zpravu pred udrzbou
+WRITER_IDLE_TIMEOUT = 1000
+#kolik prijatych zprav smi cekat na zapis do MikroTiku
+QUEUE_SIZE_DEFAULT = 10000
+#co delat pri plne fronte: block = cekat (zpravy se hromadi v ZMQ), drop = zahodit delty a nacist cely list
+QUEUE_POLICY_DEFAULT = 'block'
+#od kolika blokovanych adres v jednom bloku se do MikroTiku posle cely prefix (0 = neagregovat)
+AGGREGATE_THRESHOLD_DEFAULT = 0
+#delka prefixu agregovanych bloku
+AGGREGATE_PREFIX_DEFAULT = 24
+#za kolik sekund zaznam na MikroTiku sam vyprsi, pokud ho klient neobnovi (0 = trvale zaznamy)
+ENTRY_TIMEOUT_DEFAULT = 0
+#cely list se obnovi jednou za tuto cast timeoutu, obnova je rozlozena rovnomerne v case
+ENTRY_REFRESH_FRACTION = 0.5
+#kolik zaznamu se obnovi jednim prikazem set
+ENTRY_REFRESH_BATCH = 500
+#kolik zaznamu se nejvyse obnovi najednou, kdyz obnova zaostava (napr. po vypadku spojeni)
+ENTRY_REFRESH_MAX = 20 * ENTRY_REFRESH_BATCH
+#za kolik sekund se cely address-list po blocich porovna s MikroTikem (0 = neporovnavat)
+AUDIT_INTERVAL_DEFAULT = 0
+#kolik adres ma priblizne jeden porovnavany blok (podle toho se voli delka prefixu bloku)
+AUDIT_BUCKET_SIZE = 1000
+#nejdelsi prefix bloku
+AUDIT_PREFIX_MAX = 16
+#kolik bloku se nejvyse porovna pri jedne necinnosti zapisovaciho vlakna
+AUDIT_BUCKETS_MAX = 4
+#jaka cast listu smi byt v jednom pruchodu opravena, nez se misto oprav nacte cely list znovu
+AUDIT_REPAIR_FRACTION = 0.1
+#po kolika sekundach se poprve zopakuje prikaz, ktery router odmitl neocekavanou chybou (kazdy dalsi pokus 2x pozdeji)
+RETRY_DELAY_MIN = 1
+#nejdelsi cekani na dalsi pokus
+RETRY_DELAY_MAX = 300
+#po kolika neuspesnych pokusech se prikaz zahodi
+RETRY_ATTEMPTS_MAX = 8
+#kolik .id se odebere jednim prikazem remove pri mazani celeho address-listu
+REMOVE_BATCH = 1000
+#kam se uklada stav pro rychly restart (prazdne = neukladat)
+CHECKPOINT_PATH_DEFAULT = "./var/run/dynfw.checkpoint"
+#jak casto (v sekundach) se stav uklada
+CHECKPOINT_INTERVAL_DEFAULT = 60
+#kolik nahodnych zaznamu se pri startu overi na MikroTiku
+CHECKPOINT_VERIFY_SAMPLE = 16
+#po kolika adresach se LIST zprava dekoduje a zapisuje do MikroTiku
+LIST_CHUNK_SIZE = 10000
+#po kolika bajtech cte msgpack dekoder LIST zpravu
+LIST_READ_SIZE = 256 * 1024
+#kolik odmitnutych adres z LIST zpravy se vypise do logu
+INGEST_REJECTED_SAMPLES = 5
+#jak se pri --bulk-load nahraje .rsc skript na MikroTik: off = jen API prikazy add, api = /file add, ftp = FTP
+BULK_LOAD_DEFAULT = 'off'
+#od kolika chybejicich adres (v jedne casti LIST zpravy) se misto API prikazu add pouzije /import
+BULK_LOAD_MIN = 2000
+#kolik adres se zapise do jednoho .rsc souboru nahraneho pres FTP
+BULK_LOAD_FILE_ENTRIES = 100000
+#nejvetsi .rsc soubor zapsany pres API (/file add contents=...)
+BULK_LOAD_API_FILE_SIZE = 4095
+#na jake adrese se pri --metrics-port posloucha (jen lokalne)
+METRICS_ADDRESS_DEFAULT = '127.0.0.1'
+#hranice histogramu dob (v sekundach) a velikosti davek
+METRICS_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
 
 
 SERVER_CERT_URL = "https://repo.turris.cz/sentinel/dynfw.pub"
@@ -46,6 +163,166 @@ REQUIRED_LIST_KEYS = (
 
 # Source: https://riptutorial.com/regex/example/14146/match-an-ip-address
 RE_IPV4 = r"^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)$"
+IPV4_REGEXP = re.compile(RE_IPV4)
+
+# Errors after which the API session can't be trusted anymore and has to be reconnected
+ROUTER_CONNECTION_ERRORS = (
+    routeros_api.exceptions.RouterOsApiConnectionError,
+    routeros_api.exceptions.RouterOsApiFatalCommunicationError,
+    routeros_api.exceptions.FatalRouterOsApiError,
+    socket.error,
+)
+
+
+class Metric:
+    # Prometheus-style metric, values per tuple of label values
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _label_text(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for values, value in items:
+            lines.extend(self._render_value(values, value))
+        return lines
+
+    def _render_value(self, values, value):
+        return ["{}{} {}".format(self.name, self._label_text(values), format_metric(value))]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    # current value taken from a function when scraped
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.functions = {}
+
+    def set_function(self, func, *labels):
+        with self.lock:
+            self.functions[labels] = func
+
+    def render(self):
+        with self.lock:
+            functions = list(self.functions.items())
+        for labels, func in functions:
+            value = func()
+            with self.lock:
+                self.values[labels] = value
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[slot] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, *labels)
+
+    def _render_value(self, values, counts):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            le = bound if bound == "+Inf" else format_metric(bound)
+            lines.append("{}_bucket{} {}".format(self.name, self._label_text(values, [("le", le)]), total))
+        lines.append("{}_sum{} {}".format(self.name, self._label_text(values), format_metric(counts[-1])))
+        lines.append("{}_count{} {}".format(self.name, self._label_text(values), total))
+        return lines
+
+
+def format_metric(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = ("\n".join(line for metric in METRICS for line in metric.render()) + "\n").encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request: " + format, *args)
+
+
+def start_metrics_server(address, port):
+    # serve /metrics from a daemon thread, scraping must never slow down the writer
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", address, server.server_address[1])
+    return server
+
+
+MESSAGES_RECEIVED = Counter("sentynel_messages_received_total", "Messages received from the dynfw feed",
+                            ("topic",))
+PARSE_FAILURES = Counter("sentynel_parse_failures_total", "Messages that could not be decoded or lack keys")
+SERIAL_GAPS = Counter("sentynel_serial_gaps_total", "Delta serial gaps (missing delta, deltas held meanwhile)")
+LIST_RELOADS = Counter("sentynel_list_reloads_total", "Full list reloads requested", ("reason",))
+DELTAS_DROPPED = Counter("sentynel_deltas_dropped_total", "Deltas dropped on a full queue (--queue-policy drop)")
+QUEUE_DEPTH = Gauge("sentynel_queue_depth", "Messages waiting for the router writer")
+ROUTER_RPC_SECONDS = Histogram("sentynel_router_rpc_seconds", "RouterOS API command latency", ("operation",))
+COMMIT_BATCH_SIZE = Histogram("sentynel_commit_batch_size", "Router commands sent by one commit",
+                              buckets=METRICS_SIZE_BUCKETS)
+FEED_LAG_SECONDS = Histogram("sentynel_feed_lag_seconds",
+                             "Time from receiving a message to having it applied (without the delta batch window)",
+                             ("topic",))
+WRITE_WINDOW = Gauge("sentynel_write_window", "Pipelined commands allowed by the adaptive write controller",
+                     ("router", "list"))
+AUDIT_BUCKETS = Counter("sentynel_audit_buckets_total", "Address-list buckets compared with the router",
+                        ("result",))
+ROUTER_RETRIES = Counter("sentynel_router_retries_total", "Failed router commands replayed or given up",
+                         ("result",))
+RETRY_QUEUE_DEPTH = Gauge("sentynel_retry_queue_depth", "Failed router commands waiting for a retry",
+                          ("router", "list"))
+METRICS = (MESSAGES_RECEIVED, PARSE_FAILURES, SERIAL_GAPS, LIST_RELOADS, DELTAS_DROPPED, QUEUE_DEPTH,
+           ROUTER_RPC_SECONDS, COMMIT_BATCH_SIZE, FEED_LAG_SECONDS, WRITE_WINDOW, AUDIT_BUCKETS, ROUTER_RETRIES,
+           RETRY_QUEUE_DEPTH)
 
 
 
@@ -88,110 +365,1752 @@ def wait_for_connection(socket):
     monitor.close()
 
 
+class RouterSession:
+    # One logged-in RouterOS API session, reconnected on demand
+    def __init__(self, host, username, password, port):
+        self.pool = routeros_api.RouterOsApiPool(host, username=username, password=password, port=port,
+                                                 plaintext_login=True)
+        self.last_used = 0
+
+    def get_api(self, health_check_interval):
+        if self.pool.connected and time.monotonic() - self.last_used > health_check_interval:
+            # idle connection might have been silently dropped by the router or a NAT in between
+            try:
+                self.pool.api.get_binary_resource('/system/identity').call('print')
+            except ROUTER_CONNECTION_ERRORS as e:
+                logger.info("RouterOS API session is dead, reconnecting: %s", e)
+                self.disconnect()
+        if not self.pool.connected:
+            logger.debug("connecting to RouterOS API %s:%d", self.pool.host, self.pool.port)
+            self.pool.get_api()
+            # the library writes every API word separately, don't let Nagle hold them back waiting for ACKs
+            self.pool.socket.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.last_used = time.monotonic()
+        return self.pool.api
+
+    def disconnect(self):
+        try:
+            self.pool.disconnect()
+        except OSError:
+            pass
+
+
+class RouterConnection:
+    # Long-lived pool of RouterOS API sessions shared by everything talking to one router
+    def __init__(self, host, username, password, port=8728, sessions=1,
+                 health_check_interval=ROUTER_HEALTH_CHECK_INTERVAL):
+        self.host = host
+        self.username = username
+        self.password = password  # for FTP uploads, see Ipset.bulk_add
+        self.health_check_interval = health_check_interval
+        self.all_sessions = [RouterSession(host, username, password, port) for _ in range(max(1, sessions))]
+        self.sessions = queue.LifoQueue()
+        for session in self.all_sessions:
+            self.sessions.put(session)
+
+    @contextlib.contextmanager
+    def session(self):
+        session = self.sessions.get()
+        try:
+            yield session.get_api(self.health_check_interval)
+        except ROUTER_CONNECTION_ERRORS:
+            session.disconnect()
+            raise
+        finally:
+            self.sessions.put(session)
+
+    def call(self, func, *args, **kwargs):
+        # run func(api, ...) and transparently retry once on a fresh session if the connection broke
+        try:
+            with self.session() as api:
+                return func(api, *args, **kwargs)
+        except ROUTER_CONNECTION_ERRORS as e:
+            logger.warning("RouterOS API connection to %s lost, reconnecting: %s", self.host, e)
+        with self.session() as api:
+            return func(api, *args, **kwargs)
+
+    def close(self):
+        for session in self.all_sessions:
+            session.disconnect()
+
+
+def _response_buffer(api, promise):
+    # (ApiCommunicatorBase, its buffered response of the promise) - internals of routeros_api 0.17 (pinned in
+    # requirements.txt), (None, None) when the installed version doesn't have them
+    try:
+        communicator = api.communicator.exception_aware_communicator.inner.inner
+        response = communicator.response_buffor[promise.inner.tag]
+    except (AttributeError, KeyError, TypeError):
+        return None, None
+    if not callable(getattr(communicator, 'process_single_response', None)) or not all(
+            hasattr(response, name) for name in ('done', 'error', 'error_as_exception', '__delitem__')):
+        return None, None
+    return communicator, response
+
+
+def stream_print(api, path, proplist, queries=None):
+    # !re replies of a print one by one as they arrive, only the proplist attributes (like b'.id,address') of the
+    # entries matching the ?key=value queries on the router. Rows look like those of get_binary_resource():
+    # str keys ('id' for .id) and bytes values. routeros_api keeps every reply of a command until its !done,
+    # rows handed over are dropped from its buffer, so memory stays flat even for a list of 100k+ entries.
+    promise = api.get_binary_resource(path).call_async('print', {'.proplist': proplist}, queries)
+    communicator, response = _response_buffer(api, promise)
+    if communicator is None:
+        # the whole reply at once through the public API, still narrowed to proplist and queries
+        logger.debug("routeros_api internals not available, reading %s print at once", path)
+        yield from promise.get()
+        return
+    tag = promise.inner.tag
+    try:
+        while True:
+            if response:
+                rows = response[:]
+                del response[:]
+                for row in rows:
+                    yield {(b'id' if key == b'.id' else key).decode(): value for key, value in row.items()}
+            elif response.done:
+                break
+            else:
+                communicator.process_single_response()
+    except GeneratorExit:
+        # the rest of an abandoned print still arrives, read it before the session is used again
+        while not response.done:
+            communicator.process_single_response()
+        raise
+    finally:
+        communicator.response_buffor.pop(tag, None)
+    if response.error:
+        raise response.error_as_exception
+
+
+def ip_to_int(ip):
+    # dotted decimal as matched by RE_IPV4, "010" is 10 (inet_aton would read it as octal)
+    if not isinstance(ip, str) or not IPV4_REGEXP.fullmatch(ip):
+        raise ValueError("not an IPv4 address: {}".format(ip))
+    return int.from_bytes(bytes(int(octet) for octet in ip.split('.')), 'big')
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def bucket_digest(values):
+    # hash of a sorted array('I') of addresses, equal on both sides when the bucket matches
+    return hashlib.blake2b(values.tobytes(), digest_size=16).digest()
+
+
+def sorted_difference(first, second):
+    # items of sorted array first missing in sorted array second
+    result = array.array('I')
+    j, count = 0, len(second)
+    for value in first:
+        while j < count and second[j] < value:
+            j += 1
+        if j == count or second[j] != value:
+            result.append(value)
+    return result
+
+
+# addresses: sorted array('I') of unique accepted addresses, samples: a few of the rejected items
+IngestReport = collections.namedtuple('IngestReport', 'addresses received rejected samples')
+
+
+class ListIngest:
+    # Validates, normalizes, deduplicates and sorts a LIST payload, vectorized with NumPy when it is installed.
+    # The payload may come in chunks, rejected entries are reported once for all of them.
+    def __init__(self):
+        self.parts = []
+        self.received = 0
+        self.rejected = 0
+        self.samples = []
+
+    def add(self, ips):
+        # sorted unique addresses of this chunk
+        if isinstance(ips, array.array):
+            report = IngestReport(ips, len(ips), 0, [])  # already packed and sorted
+        elif numpy is not None and len(ips) and all(type(ip) is str and '\0' not in ip for ip in ips):
+            # numpy.array() would turn ints and bytes into strings as well and strips trailing NULs
+            report = _ingest_numpy(numpy.array(ips))
+        else:
+            report = _ingest_python(ips)
+        self.parts.append(report.addresses)
+        self.received += report.received
+        self.rejected += report.rejected
+        self.samples.extend(report.samples[:INGEST_REJECTED_SAMPLES - len(self.samples)])
+        return report.addresses
+
+    def finish(self):
+        if len(self.parts) == 1:
+            addresses = self.parts[0]
+        else:
+            # chunks are sorted already, merge them dropping duplicates
+            addresses = array.array('I')
+            for address in heapq.merge(*self.parts):
+                if not addresses or addresses[-1] != address:
+                    addresses.append(address)
+        self.parts = []
+        if self.rejected:
+            logger.warning("%d of %d addresses skipped as they are not IPv4, e.g. %s", self.rejected, self.received,
+                           ", ".join(repr(ip) for ip in self.samples))
+        return IngestReport(addresses, self.received, self.rejected, self.samples)
+
+
+def ingest_addresses(ips):
+    ingest = ListIngest()
+    ingest.add(ips)
+    return ingest.finish()
+
+
+def _ingest_python(ips):
+    # only strings, like the NumPy path: ints and bools in a LIST are rejected, packed input is an array('I')
+    packed = set()
+    rejected = 0
+    samples = []
+    for ip in ips:
+        try:
+            packed.add(ip_to_int(ip))
+        except ValueError:
+            rejected += 1
+            if len(samples) < INGEST_REJECTED_SAMPLES:
+                samples.append(ip)
+    return IngestReport(array.array('I', sorted(packed)), len(ips), rejected, samples)
+
+
+def _ingest_numpy(text):
+    # every string as a row of unicode code points, "255.255.255.255" is the longest valid one
+    count = len(text)
+    width = text.dtype.itemsize // 4
+    codes = text.view(numpy.uint32).reshape(count, width)
+    valid = numpy.ones(count, dtype=bool)
+    if width > 15:
+        valid &= ~codes[:, 15:].any(axis=1)
+        codes = codes[:, :15]
+        width = 15
+    digit = (codes >= ord('0')) & (codes <= ord('9'))
+    dot = codes == ord('.')
+    pad = codes == 0
+    valid &= (digit | dot | pad).all(axis=1)
+    valid &= (numpy.maximum.accumulate(pad, axis=1) == pad).all(axis=1)  # nothing after the end of the string
+    valid &= dot.sum(axis=1) == 3
+    # left to right over the columns: digits of the octet being read, their count and the octets finished so far
+    octet = numpy.zeros(count, dtype=numpy.uint32)
+    length = numpy.zeros(count, dtype=numpy.uint32)
+    packed = numpy.zeros(count, dtype=numpy.uint32)
+    previous_pad = numpy.zeros(count, dtype=bool)
+    for column in range(width + 1):
+        # an octet ends at a dot and at the end of the string
+        if column < width:
+            end = dot[:, column] | (pad[:, column] & ~previous_pad)
+        else:
+            end = ~previous_pad
+        valid &= ~end | ((length >= 1) & (length <= 3) & (octet <= 255))
+        packed = numpy.where(end, (packed << 8) | octet, packed)
+        octet[end] = 0
+        length[end] = 0
+        if column < width:
+            has_digit = digit[:, column]
+            octet = numpy.where(has_digit, octet * 10 + (codes[:, column] - ord('0')), octet)
+            length += has_digit
+            previous_pad = pad[:, column]
+    packed = numpy.sort(packed[valid])
+    if len(packed):
+        packed = packed[numpy.concatenate(([True], packed[1:] != packed[:-1]))]
+    addresses = array.array('I')
+    addresses.frombytes(packed.tobytes())
+    rejected = numpy.flatnonzero(~valid)
+    return IngestReport(addresses, count, len(rejected), text[rejected[:INGEST_REJECTED_SAMPLES]].tolist())
+
+
+def pack_addresses(ips):
+    # validated IPv4 address strings (or an already packed array('I')) as a sorted array of unique 32-bit ints
+    if isinstance(ips, array.array):
+        return array.array('I', ips)  # already packed and sorted
+    return ingest_addresses(ips).addresses
+
+
+def collect_addresses(chunks):
+    # pack_addresses over a LIST streamed in chunks
+    ingest = ListIngest()
+    for chunk in chunks:
+        ingest.add(chunk)
+    return ingest.finish().addresses
+
+
+class PackedAddressSet:
+    # Set of IPv4 addresses kept as a sorted array of 32-bit ints (4 bytes per address instead of a str in a set),
+    # membership by binary search. Accepts addresses as strings or ints, iterates ints in ascending order.
+    def __init__(self, addresses=None):
+        self.values = addresses if addresses is not None else array.array('I')
+
+    @staticmethod
+    def _key(ip):
+        if isinstance(ip, int):
+            return ip
+        try:
+            return ip_to_int(ip)
+        except ValueError:
+            return None
+
+    def _find(self, value):
+        i = bisect.bisect_left(self.values, value)
+        return i, i < len(self.values) and self.values[i] == value
+
+    def __contains__(self, ip):
+        value = self._key(ip)
+        return value is not None and self._find(value)[1]
+
+    def add(self, ip):
+        value = self._key(ip)
+        if value is None:
+            raise ValueError("not an IPv4 address: {}".format(ip))
+        i, found = self._find(value)
+        if not found:
+            self.values.insert(i, value)
+
+    def discard(self, ip):
+        value = self._key(ip)
+        if value is None:
+            return
+        i, found = self._find(value)
+        if found:
+            del self.values[i]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+class PackedIdMap:
+    # IPv4 address -> RouterOS .id number, as two parallel arrays sorted by address.
+    # New ids go to a small dict first and are merged in bulk, so a large reconcile doesn't insert one by one.
+    def __init__(self, pairs=()):
+        pairs = sorted(pairs)
+        self.addresses = array.array('I', (address for address, _ in pairs))
+        self.ids = array.array('I', (entry_id for _, entry_id in pairs))
+        self.recent = {}
+
+    @classmethod
+    def from_keys(cls, keys):
+        # from an array('Q') of address << 32 | id in any order, without a tuple per entry
+        ids = cls()
+        if numpy is not None:
+            keys = numpy.sort(numpy.frombuffer(keys, dtype=numpy.uint64))
+            ids.addresses.frombytes((keys >> numpy.uint64(32)).astype(numpy.uint32).tobytes())
+            ids.ids.frombytes((keys & numpy.uint64(0xFFFFFFFF)).astype(numpy.uint32).tobytes())
+        else:
+            keys = sorted(keys)
+            ids.addresses = array.array('I', (key >> 32 for key in keys))
+            ids.ids = array.array('I', (key & 0xFFFFFFFF for key in keys))
+        return ids
+
+    def _find(self, address):
+        i = bisect.bisect_left(self.addresses, address)
+        return i, i < len(self.addresses) and self.addresses[i] == address
+
+    def _merge(self):
+        if not self.recent:
+            return
+        # both runs are sorted already, timsort just merges them
+        self.__init__(list(zip(self.addresses, self.ids)) + sorted(self.recent.items()))
+
+    def set(self, address, entry_id):
+        i, found = self._find(address)
+        if found:
+            self.ids[i] = entry_id
+            return
+        self.recent[address] = entry_id
+        if len(self.recent) > max(1024, len(self.addresses) // 4):
+            self._merge()
+
+    def get(self, address):
+        if address in self.recent:
+            return self.recent[address]
+        i, found = self._find(address)
+        return self.ids[i] if found else None
+
+    def pop(self, address):
+        if address in self.recent:
+            return self.recent.pop(address)
+        i, found = self._find(address)
+        if not found:
+            return None
+        entry_id = self.ids[i]
+        del self.addresses[i]
+        del self.ids[i]
+        return entry_id
+
+    def sorted_addresses(self):
+        self._merge()
+        return array.array('I', self.addresses)
+
+    def __len__(self):
+        return len(self.addresses) + len(self.recent)
+
+
+class AddressIndex:
+    # Local shadow of the router address-lists: (list, address) -> RouterOS .id
+    # Filled by one listing when a list is loaded and kept current from the "=ret=" of every add,
+    # so removing an address is a single "remove" by .id without listing the router.
+    # Single IPv4 addresses with numeric ids are packed per list, anything else (prefixes, ranges) is kept as is.
+    def __init__(self):
+        self.lists = {}
+        self.other = {}
+
+    def load(self, api, list_name=None):
+        # replace what we know about list_name (or about all lists) by the router's current state.
+        # Entries are streamed and packed one by one, nothing but the packed ids is kept.
+        queries = {'list': list_name.encode('utf-8')} if list_name is not None else None
+        packed = {}
+        other = {}
+        count = 0
+        with ROUTER_RPC_SECONDS.time('print'):
+            for entry in stream_print(api, '/ip/firewall/address-list', b'.id,address,list', queries):
+                count += 1
+                name = entry['list'].decode('utf-8')
+                address = entry['address'].decode('utf-8')
+                key = self._pack(address, entry['id'])
+                if key is None:
+                    other[(name, address)] = entry['id'].decode('utf-8')
+                else:
+                    packed.setdefault(name, array.array('Q')).append(key[0] << 32 | key[1])
+        self.clear(list_name)
+        self.other.update(other)
+        for name, keys in packed.items():
+            self.lists[name] = PackedIdMap.from_keys(keys)
+        return count
+
+    @staticmethod
+    def _pack(address, entry_id):
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode('utf-8')
+        try:
+            packed_id = int(entry_id[1:], 16)
+            if not entry_id.startswith('*') or packed_id > 0xFFFFFFFF:
+                return None
+            return (address if isinstance(address, int) else ip_to_int(address)), packed_id
+        except ValueError:
+            return None
+
+    def add(self, list_name, address, entry_id):
+        key = self._pack(address, entry_id)
+        if key is None:
+            if isinstance(entry_id, bytes):
+                entry_id = entry_id.decode('utf-8')
+            self.other[(list_name, self._text(address))] = entry_id
+        else:
+            ids = self.lists.get(list_name)
+            if ids is None:
+                ids = self.lists[list_name] = PackedIdMap()
+            ids.set(*key)
+
+    def get(self, list_name, address):
+        return self._lookup(list_name, address, False)
+
+    def pop(self, list_name, address):
+        return self._lookup(list_name, address, True)
+
+    def _lookup(self, list_name, address, remove):
+        packed = self._pack(address, '*0')
+        ids = self.lists.get(list_name)
+        if packed is not None and ids is not None:
+            entry_id = ids.pop(packed[0]) if remove else ids.get(packed[0])
+            if entry_id is not None:
+                return '*{:X}'.format(entry_id)
+        key = (list_name, self._text(address))
+        return self.other.pop(key, None) if remove else self.other.get(key)
+
+    @staticmethod
+    def _text(address):
+        return int_to_ip(address) if isinstance(address, int) else address
+
+    def addresses(self, list_name):
+        # packed IPv4 addresses of list_name, sorted
+        ids = self.lists.get(list_name)
+        return ids.sorted_addresses() if ids is not None else array.array('I')
+
+    def other_entries(self, list_name):
+        # entries of list_name which are not a single IPv4 address
+        return [address for (name, address) in self.other if name == list_name]
+
+    def snapshot(self, list_name):
+        # (addresses, ids, other entries) of list_name for Checkpoint
+        ids = self.lists.get(list_name)
+        if ids is None:
+            ids = PackedIdMap()
+        ids.sorted_addresses()  # merges recently added ids
+        other = [(address, entry_id) for (name, address), entry_id in self.other.items() if name == list_name]
+        return ids.addresses, ids.ids, other
+
+    def restore(self, list_name, addresses, ids, other):
+        self.clear(list_name)
+        packed = PackedIdMap()
+        packed.addresses, packed.ids = addresses, ids
+        self.lists[list_name] = packed
+        for address, entry_id in other:
+            self.other[(list_name, address)] = entry_id
+
+    def count(self, list_name):
+        ids = self.lists.get(list_name)
+        return (len(ids) if ids is not None else 0) + len(self.other_entries(list_name))
+
+    def clear(self, list_name=None):
+        if list_name is None:
+            self.lists = {}
+            self.other = {}
+        else:
+            self.lists.pop(list_name, None)
+            self.other = {key: entry_id for key, entry_id in self.other.items() if key[0] != list_name}
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.lists.values()) + len(self.other)
+
+    def __contains__(self, key):
+        return self.get(*key) is not None
+
+
+OP_ADD = 1
+OP_REMOVE = 2
+OP_REFRESH = 3  # extend the timeout, batched with other refreshes into one "set"
+OP_TOUCH = 4  # extend the timeout of an entry whose .id may have to be looked up first
+OP_ENTRY = 0x80  # payload is an index into PendingOps.entries instead of a packed address
+RPC_OPERATIONS = {OP_ADD: 'add', OP_REMOVE: 'remove', OP_REFRESH: 'set', OP_TOUCH: 'set'}
+
+# characters with a special meaning inside a RouterOS script string
+SCRIPT_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '$': '\\$'})
+
+
+class BulkLoadError(Exception):
+    pass
+
+
+class PendingOps:
+    # Queued address-list changes as typed records: an op code array and a packed IPv4 address array.
+    # Entries that aren't a single IPv4 address are kept as strings aside.
+    def __init__(self):
+        self.ops = array.array('B')
+        self.values = array.array('I')
+        self.entries = []
+
+    def append(self, op, address):
+        if isinstance(address, int):
+            self.ops.append(op)
+            self.values.append(address)
+        else:
+            self.ops.append(op | OP_ENTRY)
+            self.values.append(len(self.entries))
+            self.entries.append(address)
+
+    def __iter__(self):
+        # (op, address) where address is an int or, for other entries, a string
+        for op, value in zip(self.ops, self.values):
+            if op & OP_ENTRY:
+                yield op & ~OP_ENTRY, self.entries[value]
+            else:
+                yield op, value
+
+    def __len__(self):
+        return len(self.ops)
+
+
+class WriteController:
+    # AIMD limit of pipelined commands for --write-mode adaptive. Every round (as many replies as the limit)
+    # it grows by one, unless some reply of the round took well over the lowest latency seen (commands queue
+    # up on the router), a command failed or the router CPU is over cpu_limit - then it is halved.
+    def __init__(self, minimum, maximum, cpu_limit=CPU_LIMIT_DEFAULT):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.cpu_limit = cpu_limit
+        self.window = float(self.minimum)
+        self.latency = None  # smoothed
+        self.latency_min = None
+        self.cpu_load = None
+        self.cpu_checked = 0.0
+        self.round = 0
+        self.congested = False
+        self.increases = 0
+        self.decreases = 0
+        self.completed = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def limit(self):
+        return int(self.window)
+
+    def observe(self, latency, failed=False):
+        self.completed += 1
+        if failed:
+            self.failed += 1
+            self.congested = True
+        else:
+            # the lowest latency slowly drifts up, so a slower path to the router becomes the new normal
+            self.latency_min = latency if self.latency_min is None else min(latency, self.latency_min * 1.001)
+            self.latency = latency if self.latency is None else self.latency + 0.2 * (latency - self.latency)
+            if self.latency > self.latency_min * WRITE_LATENCY_TOLERANCE + WRITE_LATENCY_SLACK:
+                self.congested = True
+        self.round += 1
+        if self.round >= self.window:
+            self._adjust()
+
+    def cpu_due(self):
+        return self.cpu_limit > 0 and time.monotonic() - self.cpu_checked >= CPU_POLL_INTERVAL
+
+    def cpu_observed(self, load):
+        self.cpu_checked = time.monotonic()
+        self.cpu_load = load
+
+    def _adjust(self):
+        # a busy CPU keeps backing off every round until the next reading
+        busy = self.cpu_limit > 0 and self.cpu_load is not None and self.cpu_load > self.cpu_limit
+        if self.congested or busy:
+            if self.window > self.minimum:
+                self.window = max(self.minimum, self.window * WRITE_DECREASE_FACTOR)
+                self.decreases += 1
+        elif self.window < self.maximum:
+            self.window = min(self.maximum, self.window + 1)
+            self.increases += 1
+        self.round = 0
+        self.congested = False
+
+    def rate(self):
+        # commands per second since the last call
+        now = time.monotonic()
+        rate = self.completed / (now - self.started) if now > self.started else 0.0
+        self.completed, self.started = 0, now
+        return rate
+
+
+class RetryQueue:
+    # Commands the router refused with an unexpected error, replayed in idle time after an exponential backoff
+    # with jitter and given up after RETRY_ATTEMPTS_MAX attempts. One entry per address, a newer change of the
+    # address supersedes it. Replaying is idempotent: an entry already there or already gone counts as done.
+    def __init__(self):
+        self.entries = {}  # address -> (op, attempts, due)
+        self.heap = []  # (due, sequence, address), entries rescheduled or discarded since are skipped
+        self.sequence = 0
+        self.replaying = {}  # address -> attempts of the replays sent by the current commit
+        self.retried = 0
+        self.abandoned = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, op, address, attempts=None):
+        # False when the command has failed too many times and is given up
+        if attempts is None:
+            attempts = self.replaying.pop(address, 0) + 1
+        if attempts > RETRY_ATTEMPTS_MAX:
+            self.abandoned += 1
+            ROUTER_RETRIES.inc('abandoned')
+            return False
+        delay = min(RETRY_DELAY_MIN * 2 ** (attempts - 1), RETRY_DELAY_MAX)
+        # commands failed together are not replayed in one burst
+        due = time.monotonic() + delay * random.uniform(0.5, 1.0)
+        self.entries[address] = (op, attempts, due)
+        self.sequence += 1
+        heapq.heappush(self.heap, (due, self.sequence, address))
+        return True
+
+    def discard(self, address):
+        self.entries.pop(address, None)
+
+    def due(self):
+        return bool(self.heap) and self.heap[0][0] <= time.monotonic()
+
+    def pop_due(self):
+        # (op, address, attempts) of the commands whose backoff has passed
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            due, _, address = heapq.heappop(self.heap)
+            entry = self.entries.get(address)
+            if entry is not None and entry[2] == due:
+                del self.entries[address]
+                yield entry[0], address, entry[1]
+
+    def clear(self):
+        self.entries = {}
+        self.heap = []
+        self.replaying = {}
+
+    def snapshot(self):
+        return [[op, address, attempts] for address, (op, attempts, _) in self.entries.items()]
+
+    def restore(self, entries):
+        self.clear()
+        for op, address, attempts in entries:
+            self.add(op, address, attempts)
+
+
 class Ipset:
-    def __init__(self, name):
+    def __init__(self, name, router, index=None, max_in_flight=1, entry_timeout=ENTRY_TIMEOUT_DEFAULT,
+                 bulk_load=BULK_LOAD_DEFAULT, write_control=None, audit_interval=AUDIT_INTERVAL_DEFAULT,
+                 writer_sessions=WRITER_SESSIONS_DEFAULT):
         self.name = name
+        self.bulk_load = bulk_load
+        self.imports = 0
+        self.router = router
+        self.index = index if index is not None else AddressIndex()
+        self.max_in_flight = max(1, max_in_flight)
+        # write_control = (min_in_flight, cpu_limit): max_in_flight becomes the upper bound of an adaptive limit
+        self.controller = None
+        if write_control is not None:
+            self.controller = WriteController(write_control[0], self.max_in_flight, write_control[1])
+            WRITE_WINDOW.set_function(lambda: self.controller.limit, router.host, name)
         self.regexp = re.compile(RE_IPV4)
-        self.commands = []
-        self.addresses = set()  # Track addresses
+        self.commands = PendingOps()
+        self.requeued = PendingOps()  # follow-up commands decided while sending, sent by the next commit
+        self.retries = RetryQueue()  # commands refused with an unexpected error, replayed by retry()
+        RETRY_QUEUE_DEPTH.set_function(lambda: len(self.retries), router.host, name)
+        # With writer_sessions > 1 a commit is split by address over that many sessions sending at the same time,
+        # the index and the follow-ups they share are only changed with the lock held
+        self.writer_sessions = max(1, writer_sessions)
+        self.executor = None
+        self.lock = threading.Lock()
+        # With entry_timeout the router expires entries itself: removed addresses are just not refreshed anymore
+        # and the ones still blocked are refreshed by a sweep over the list spread evenly over time.
+        self.entry_timeout = entry_timeout
+        self.refresh_cursor = 0
+        self.refresh_credit = 0.0
+        self.refresh_at = time.monotonic()
+        self.refreshed = 0
+        # The audit compares the router with addresses one prefix bucket at a time, a whole pass per audit_interval
+        self.audit_interval = audit_interval
+        self.audit_prefix = 0
+        self.audit_bucket = 0
+        self.audit_credit = 0.0
+        self.audit_at = time.monotonic()
+        self.audit_differed = 0  # buckets repaired in the current pass
+        self.audit_pass_repaired = 0  # and entries
+        self.audited = 0
+        self.audit_repaired = 0
+        self.addresses = PackedAddressSet()  # Track addresses
+        self.index_verified = False  # restored from a checkpoint and checked against the router
 
     def add_ip(self, ip):
-        if self.regexp.fullmatch(ip):
-            self.commands.append('add {} {}\n'.format(self.name, ip))
-            self.addresses.add(ip)  # Track added address
+        if isinstance(ip, int) or self.regexp.fullmatch(ip):
+            address = ip if isinstance(ip, int) else ip_to_int(ip)
+            if self.retries.entries:
+                self.retries.discard(address)
+            self.commands.append(OP_ADD, address)
+            self.addresses.add(address)  # Track added address
         else:
             logger.warning("IP address skipped as it is not IPv4: %s", ip)
 
     def del_ip(self, ip):
-        if ip in self.addresses:
+        if self.retries.entries:
+            self.retries.discard(PackedAddressSet._key(ip))
+        if self.entry_timeout and ip in self.addresses:
+            # left to expire on the router
+            self.addresses.discard(ip)
+            self.index.pop(self.name, ip)
+        elif ip in self.addresses or (self.name, ip) in self.index:
             # Remove the IP address from the set
-            self.addresses.remove(ip)
+            self.addresses.discard(ip)
+            address = ip if isinstance(ip, int) else PackedAddressSet._key(ip)
+            self.commands.append(OP_REMOVE, address if address is not None else ip)
+        else:
+            logger.warning("IP address not found in the list: %s", ip)
+
+    def add_network(self, network):
+        # prefix entry like "192.0.2.0/24", see AggregatedIpset
+        self.retries.discard(network)
+        self.commands.append(OP_ADD, network)
+
+    def del_network(self, network):
+        self.retries.discard(network)
+        self.commands.append(OP_REMOVE, network)
+
+    def delete_all_addresses(self):
+        # empty our address-list only, other lists on the router are left alone
+        started = time.monotonic()
+        removed = self.router.call(self._delete_all_addresses)
+        logger.info("Address-list %s cleared: %d entries removed in %.1f s", self.name, removed,
+                    time.monotonic() - started)
+        return removed
+
+    def _delete_all_addresses(self, api):
+        resource = api.get_binary_resource('/ip/firewall/address-list')
+        with ROUTER_RPC_SECONDS.time('print'):
+            ids = [entry['id'] for entry in stream_print(api, '/ip/firewall/address-list', b'.id',
+                                                         {'list': self.name.encode('utf-8')})]
+        # one remove per REMOVE_BATCH ids, pipelined like the other commands
+        in_flight = collections.deque()
+        removed = 0
+        for start in range(0, len(ids), REMOVE_BATCH):
+            batch = ids[start:start + REMOVE_BATCH]
+            in_flight.append((resource.call_async('remove', {'.id': b','.join(batch)}), batch, time.monotonic()))
+            if len(in_flight) >= self.max_in_flight:
+                removed += self._finish_remove(resource, *in_flight.popleft())
+        while in_flight:
+            removed += self._finish_remove(resource, *in_flight.popleft())
+        self.index.clear(self.name)
+        self.addresses = PackedAddressSet()
+        return removed
+
+    def _finish_remove(self, resource, promise, ids, sent):
+        # number of entries removed
+        try:
+            promise.get()
+            return len(ids)
+        except routeros_api.exceptions.RouterOsApiCommunicationError as e:
+            # an entry of the batch is already gone (expired, removed by someone else), the rest one by one
+            logger.debug("Removing %d entries at once failed, removing them one by one: %s", len(ids), e)
+        finally:
+            ROUTER_RPC_SECONDS.observe(time.monotonic() - sent, 'remove')
+        removed = 0
+        for entry_id in ids:
             try:
-                # Create a connection to the RouterOS device
-                connection = routeros_api.RouterOsApiPool(ip4, username=username, password=password, port=8728,
-                                                          plaintext_login=True)
-                api = connection.get_api()
+                resource.call('remove', {'.id': entry_id})
+                removed += 1
+            except routeros_api.exceptions.RouterOsApiCommunicationError as e:
+                logger.warning("Can't remove %s from address-list %s: %s", entry_id.decode('utf-8'), self.name, e)
+        return removed
 
-                # Send the command to the RouterOS device to remove the address
-                api.get_resource('/ip/firewall/address-list').call('remove', {
-                    'address': ip.encode('utf-8'),  # Encode as bytes
-                    'list': self.name.encode('utf-8')  # Encode as bytes
-                })
+    def commit(self):
+        # True when all queued commands reached the router
+        if not self.commands:
+            return True
+        COMMIT_BATCH_SIZE.observe(len(self.commands))
+        try:
+            self.requeued = PendingOps()
+            self._send()
+            if self.requeued:
+                # follow-ups like refreshing an entry that was still waiting to expire go out right away
+                self.commands, self.requeued = self.requeued, PendingOps()
+                self._send()
+            self.commands = self.requeued  # Reset commands
 
-                print(f"Removed IP {ip} from the address list")
+            print("Commit called. Sending commands to MikroTik firewall.")
+            return True
 
+        except ROUTER_CONNECTION_ERRORS as e:
+            logger.error("Can't reach RouterOS API, keeping %d commands for next commit: %s", len(self.commands),
+                         str(e))
+            # follow-ups decided before the connection broke are replayed once it is back
+            with self.lock:
+                for op, address in self.requeued:
+                    self.retries.add(op, address)
+            self.requeued = PendingOps()
+        return False
+
+    def _send(self):
+        if self.writer_sessions == 1:
+            self.router.call(self._send_commands, self.commands)
+            return
+        shards = [PendingOps() for _ in range(self.writer_sessions)]
+        for op, address in self.commands:
+            # the same address always goes to the same session, so its add and remove stay in order
+            shards[hash(address) % self.writer_sessions].append(op, address)
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.writer_sessions,
+                                                                  thread_name_prefix="writer-" + self.name)
+        futures = [(shard, self.executor.submit(self.router.call, self._send_commands, shard))
+                   for shard in shards if shard]
+        failed, error = PendingOps(), None
+        for shard, future in futures:
+            try:
+                future.result()
+            except ROUTER_CONNECTION_ERRORS as e:
+                error = e
+                for op, address in shard:
+                    failed.append(op, address)
+        if error is not None:
+            # what the other sessions sent is done, only the rest is kept for the next commit
+            self.commands = failed
+            raise error
+
+    def _send_commands(self, api, commands):
+        resource = api.get_binary_resource('/ip/firewall/address-list')
+        # Commands are sent as tagged API sentences without waiting for the reply of the previous one,
+        # at most max_in_flight of them are waiting for their !done/!trap at any time (1 = sequential).
+        in_flight = collections.deque()
+        refresh = []
+        self._check_router_load(api)
+        for op, address in commands:
+            if op == OP_REFRESH:
+                refresh.append(address)  # sent together once the adds before them have their .id
+                continue
+            ip_address = int_to_ip(address) if isinstance(address, int) else address
+            try:
+                if op == OP_ADD:
+                    # Send the command to the RouterOS device
+                    arguments = {
+                        'address': ip_address.encode('utf-8'),  # Encode as bytes
+                        'list': self.name.encode('utf-8')  # Encode as bytes
+                    }
+                    if self.entry_timeout and isinstance(address, int):
+                        arguments['timeout'] = str(int(self.entry_timeout)).encode('utf-8')
+                    promise = resource.call_async('add', arguments)
+                elif op == OP_REMOVE:
+                    entry_id = self._entry_id(resource, address)
+                    if entry_id is None:
+                        continue
+                    promise = resource.call_async('remove', {'.id': entry_id})
+                elif op == OP_TOUCH:
+                    if address not in self.addresses:
+                        continue  # unblocked meanwhile
+                    entry_id = self._entry_id(resource, address, pop=False)
+                    with self.lock:
+                        if entry_id is None:
+                            self.requeued.append(OP_ADD, address)  # already expired
+                            continue
+                        self.index.add(self.name, address, entry_id)
+                    promise = self._set_timeout(resource, [entry_id])
+                else:
+                    continue
             except routeros_api.exceptions.RouterOsApiCommunicationError as e:
-                logger.error("Error removing address from the list: %s", str(e))
+                if self._command_failed(op, ip_address, e):
+                    with self.lock:
+                        self._retry_later(op, address)
+                continue
+            in_flight.append((promise, op, address, time.monotonic()))
+            while len(in_flight) >= self._in_flight_limit():
+                self._finish_command(*in_flight.popleft())
+                self._check_router_load(api)
+        while in_flight:
+            self._finish_command(*in_flight.popleft())
+        for start in range(0, len(refresh), ENTRY_REFRESH_BATCH):
+            batch, ids = [], []
+            with self.lock:
+                for address in refresh[start:start + ENTRY_REFRESH_BATCH]:
+                    entry_id = self.index.get(self.name, address)
+                    if entry_id is None:
+                        self.requeued.append(OP_TOUCH, address)
+                    else:
+                        batch.append(address)
+                        ids.append(entry_id.encode('utf-8'))
+            if ids:
+                in_flight.append((self._set_timeout(resource, ids), OP_REFRESH, batch, time.monotonic()))
+            while len(in_flight) >= self._in_flight_limit():
+                self._finish_command(*in_flight.popleft())
+        while in_flight:
+            self._finish_command(*in_flight.popleft())
+
+    def _in_flight_limit(self):
+        return self.controller.limit if self.controller is not None else self.max_in_flight
+
+    def _check_router_load(self, api):
+        # CPU load for the adaptive limit, a busy router forwards packets slower
+        if self.controller is None or not self.controller.cpu_due():
+            return
+        try:
+            with ROUTER_RPC_SECONDS.time('print'):
+                found = api.get_binary_resource('/system/resource').call('print', {'.proplist': b'cpu-load'})
+            self.controller.cpu_observed(int(found[0]['cpu-load']))
+        except (routeros_api.exceptions.RouterOsApiCommunicationError, IndexError, KeyError, ValueError) as e:
+            self.controller.cpu_checked = time.monotonic()
+            logger.debug("Can't read CPU load of %s: %s", self.router.host, e)
+
+    def _set_timeout(self, resource, ids):
+        return resource.call_async('set', {'.id': b','.join(ids),
+                                           'timeout': str(int(self.entry_timeout)).encode('utf-8')})
+
+    def _finish_command(self, promise, op, address, sent):
+        try:
+            response, error = promise.get(), None
+        except routeros_api.exceptions.RouterOsApiCommunicationError as e:
+            response, error = None, e
+        # from sending the command, so waiting behind other pipelined commands is included
+        latency = time.monotonic() - sent
+        ROUTER_RPC_SECONDS.observe(latency, RPC_OPERATIONS[op])
+        with self.lock:
+            failed = self._command_done(op, address, response, error)
+            if self.controller is not None:
+                self.controller.observe(latency, failed)
+
+    def _command_done(self, op, address, response, e):
+        # True when the command failed for another reason than the entry being there already / missing
+        ip_address = int_to_ip(address) if isinstance(address, int) else address
+        if e is not None:
+            if op == OP_REFRESH:
+                # some entry of the batch is gone, find out which one by one
+                for refreshed in address:
+                    self.requeued.append(OP_TOUCH, refreshed)
+            elif self.entry_timeout and op == OP_ADD and "failure: already have such entry" in str(e):
+                self.requeued.append(OP_TOUCH, address)  # still there, waiting to expire
+            elif op == OP_TOUCH and "no such item" in str(e):
+                self.index.pop(self.name, address)
+                self.requeued.append(OP_ADD, address)  # expired in the meantime
+            elif self._command_failed(op, ip_address, e):
+                self._retry_later(op, address)
+                return True
+            return False
+        if op == OP_REFRESH:
+            self.refreshed += len(address)
+        elif op == OP_TOUCH:
+            self.refreshed += 1
+        elif op == OP_ADD:
+            if 'ret' in response.done_message:
+                self.index.add(self.name, address, response.done_message['ret'])
+        else:
+            print(f"Removed IP {ip_address} from the address list")
+        return False
+
+    def _command_failed(self, op, ip_address, e):
+        # True for errors other than the entry being there already / missing
+        cmd = '{} {} {}'.format(RPC_OPERATIONS[op], self.name, ip_address)
+        if "failure: already have such entry" in str(e):
+            logger.warning("Address already exists in the list: %s", cmd)
+        elif "failure: entry not found" in str(e) or "no such item" in str(e):
+            # "no such item" - stale .id in the index, entry was removed on the router by someone else
+            logger.warning("Address not found in the list: %s", cmd)
+        else:
+            logger.error("Error modifying address list: %s", str(e))
+            return True
+        return False
+
+    def _retry_later(self, op, address):
+        # with self.lock held
+        if op not in (OP_ADD, OP_REMOVE) or self.retries.add(op, address):
+            return
+        ip_address = int_to_ip(address) if isinstance(address, int) else address
+        logger.error("Giving up %s %s %s after %d attempts", RPC_OPERATIONS[op], self.name, ip_address,
+                     RETRY_ATTEMPTS_MAX)
+
+    def retry(self):
+        # replay the failed commands whose backoff has passed and which still match the tracked addresses
+        if not self.retries.due():
+            return True
+        replayed = 0
+        for op, address, attempts in self.retries.pop_due():
+            if isinstance(address, int) and (address in self.addresses) == (op == OP_REMOVE):
+                continue  # blocked or unblocked again since, that change was sent instead
+            self.commands.append(op, address)
+            self.retries.replaying[address] = attempts
+            replayed += 1
+        self.retries.retried += replayed
+        ROUTER_RETRIES.inc('retried', amount=replayed)
+        committed = self.commit()
+        # the ones that failed again are back in the queue with one more attempt
+        self.retries.replaying = {}
+        return committed
+
+    def _entry_id(self, resource, address, pop=True):
+        with self.lock:
+            entry_id = self.index.pop(self.name, address) if pop else self.index.get(self.name, address)
+        if entry_id is None:
+            # not added by us since the index was loaded - ask the router for this single entry
+            ip_address = int_to_ip(address) if isinstance(address, int) else address
+            with ROUTER_RPC_SECONDS.time('print'):
+                found = resource.call('print', {'.proplist': b'.id'}, {'list': self.name.encode('utf-8'),
+                                                                       'address': ip_address.encode('utf-8')})
+            if not found:
+                logger.warning("Address not found in the list: %s", ip_address)
+                return None
+            entry_id = found[0]['id']
+        if isinstance(entry_id, str):
+            entry_id = entry_id.encode('utf-8')
+        return entry_id
+
+    def reconcile(self, ips, networks=()):
+        return self.reconcile_chunks([ips], networks)
+
+    def reconcile_chunks(self, chunks, networks=()):
+        # make our address-list on the router equal to the addresses in chunks (and prefix entries networks)
+        # with as few writes as possible. Missing addresses are written chunk by chunk while the rest of
+        # the list is still being decoded, stale ones are removed once the whole list is known.
+        self.commands = PendingOps()  # the difference computed below covers anything still queued
+        if self.index_verified:
+            # index from the checkpoint was just verified, no need to list the router again
+            self.index_verified = False
+            self.addresses = PackedAddressSet(self.index.addresses(self.name))
+            current_count = self.index.count(self.name)
+        else:
+            current_count = self.load_index()
+            self.retries.clear()  # covered by the difference against the router as well
+        current = self.addresses.values
+        other = set(self.index.other_entries(self.name))
+        networks_to_remove = sorted(other.difference(networks))
+        networks_to_add = sorted(set(networks).difference(other))
+        # new prefixes first, so that nothing they cover is unblocked meanwhile
+        for network in networks_to_add:
+            self.commands.append(OP_ADD, network)
+        added = len(networks_to_add)
+        ingest = ListIngest()
+        imported = 0
+        for chunk in chunks:
+            # an address repeated in a later chunk is refused by the router as "already have such entry"
+            missing = sorted_difference(ingest.add(chunk), current)
+            added += len(missing)
+            if self.bulk_load != 'off' and len(missing) >= BULK_LOAD_MIN:
+                missing = self.bulk_add(missing)  # the rest still to be added through the API
+                imported += 1
+            for address in missing:
+                self.commands.append(OP_ADD, address)
+            self.commit()
+        if imported:
+            # .ids of the imported entries for later removals
+            self.router.call(self.index.load, self.name)
+        wanted = ingest.finish().addresses
+        to_remove = sorted_difference(current, wanted)
+        for address in to_remove:
+            self.commands.append(OP_REMOVE, address)
+        for network in networks_to_remove:
+            self.commands.append(OP_REMOVE, network)
+        self.addresses = PackedAddressSet(wanted)
+        self.commit()
+        # wipe-and-reload would delete every current entry and add every wanted one
+        removed = len(to_remove) + len(networks_to_remove)
+        unchanged = len(wanted) + len(networks) - added
+        saved = current_count + len(wanted) + len(networks) - added - removed
+        logger.info("LIST reconciled: %d added, %d removed, %d unchanged (%d router writes saved)",
+                    added, removed, unchanged, saved)
+        return added, removed, saved
+
+    def bulk_add(self, addresses):
+        # add many addresses with one /import of generated .rsc scripts instead of an API add per address,
+        # returns the addresses which still have to be added through the API
+        started = time.monotonic()
+        try:
+            before, after, files = self.router.call(self._import_addresses, addresses)
+        except (routeros_api.exceptions.RouterOsApiCommunicationError, BulkLoadError) as e:
+            logger.warning("Bulk load of %d addresses failed, adding them through the API: %s", len(addresses), e)
+            return self._not_imported(addresses)
+        if after - before != len(addresses):
+            logger.warning("Bulk load of %d addresses added %d entries, adding the rest through the API",
+                           len(addresses), after - before)
+            return self._not_imported(addresses)
+        self.imports += 1
+        logger.info("Bulk loaded %d addresses from %d files in %.1f s", len(addresses), files,
+                    time.monotonic() - started)
+        return array.array('I')
+
+    def _not_imported(self, addresses):
+        self.router.call(self.index.load, self.name)
+        return sorted_difference(addresses, self.index.addresses(self.name))
+
+    def _import_addresses(self, api, addresses):
+        resource = api.get_binary_resource('/ip/firewall/address-list')
+        before = self._count(resource)
+        files = 0
+        for script in self._render_scripts(addresses):
+            name = 'sentynel-import-{}-{}.rsc'.format(os.getpid(), files)
+            self._upload(api, name, script)
+            try:
+                with ROUTER_RPC_SECONDS.time('import'):
+                    api.get_binary_resource('/').call('import', {'file-name': name.encode('utf-8')})
             finally:
-                if connection:
-                    connection.disconnect()
+                api.get_binary_resource('/file').call('remove', {'numbers': name.encode('utf-8')})
+            files += 1
+        return before, self._count(resource), files
+
+    def _count(self, resource):
+        with ROUTER_RPC_SECONDS.time('print'):
+            response = resource.call('print', {'count-only': b''}, {'list': self.name.encode('utf-8')})
+        return int(response.done_message.get('ret', b'0'))
+
+    def _render_scripts(self, addresses):
+        # .rsc scripts adding addresses, split by entry count (FTP) or by size (API file contents)
+        header = '/ip firewall address-list\n'
+        suffix = ' timeout={}'.format(int(self.entry_timeout)) if self.entry_timeout else ''
+        prefix = 'add list="{}" address='.format(self.name.translate(SCRIPT_ESCAPES))
+        lines = []
+        size = len(header)
+        for address in addresses:
+            line = prefix + int_to_ip(address) + suffix + '\n'
+            full = (len(lines) >= BULK_LOAD_FILE_ENTRIES if self.bulk_load == 'ftp'
+                    else size + len(line) > BULK_LOAD_API_FILE_SIZE)
+            if full and lines:
+                yield header + ''.join(lines)
+                lines = []
+                size = len(header)
+            lines.append(line)
+            size += len(line)
+        if lines:
+            yield header + ''.join(lines)
+
+    def _upload(self, api, name, script):
+        if self.bulk_load == 'ftp':
+            try:
+                with ftplib.FTP(self.router.host, self.router.username, self.router.password, timeout=60) as ftp:
+                    ftp.storbinary('STOR ' + name, io.BytesIO(script.encode('utf-8')))
+            except ftplib.all_errors as e:
+                # not a broken API session, the FTP service may just be disabled
+                raise BulkLoadError("FTP upload of {} failed: {}".format(name, e))
         else:
-            logger.warning("IP address not found in the list: %s", ip)
+            with ROUTER_RPC_SECONDS.time('file'):
+                api.get_binary_resource('/file').call('add', {'name': name.encode('utf-8'),
+                                                              'contents': script.encode('utf-8')})
+
+    def refresh(self):
+        # queue the timeout refresh of the addresses whose turn has come: the sweep goes over the whole list
+        # once per entry_timeout * ENTRY_REFRESH_FRACTION, in batches of ENTRY_REFRESH_BATCH
+        if not self.entry_timeout:
+            return
+        now = time.monotonic()
+        period = self.entry_timeout * ENTRY_REFRESH_FRACTION
+        count = len(self.addresses)
+        self.refresh_credit = min(self.refresh_credit + count * (now - self.refresh_at) / period, ENTRY_REFRESH_MAX)
+        self.refresh_at = now
+        due = min(int(self.refresh_credit), count)
+        if not due or due < min(ENTRY_REFRESH_BATCH, count):
+            return
+        self.refresh_credit -= due
+        values = self.addresses.values
+        position = bisect.bisect_left(values, self.refresh_cursor)
+        for i in range(due):
+            address = values[(position + i) % count]
+            self.commands.append(OP_REFRESH, address)
+        self.refresh_cursor = address + 1
+        self.commit()
+
+    def audit(self):
+        # compare the buckets whose turn has come with the router and repair the ones that differ.
+        # True when too many differ and the whole list should rather be loaded again.
+        if not self.audit_interval or self.commands:
+            return False  # pending commands would show up as a difference
+        if not self.audit_bucket:
+            # about AUDIT_BUCKET_SIZE addresses per bucket, so a bucket is one short print
+            self.audit_prefix = min((len(self.addresses) // AUDIT_BUCKET_SIZE).bit_length(), AUDIT_PREFIX_MAX)
+        now = time.monotonic()
+        self.audit_credit = min(self.audit_credit + (1 << self.audit_prefix) * (now - self.audit_at) /
+                                self.audit_interval, AUDIT_BUCKETS_MAX)
+        self.audit_at = now
+        if self.audit_credit < 1:
+            return False
+        buckets = []
+        while self.audit_credit >= 1 and self.audit_bucket + len(buckets) < 1 << self.audit_prefix:
+            buckets.append(self.audit_bucket + len(buckets))
+            self.audit_credit -= 1
+        try:
+            differed = self.router.call(self._audit_buckets, buckets)
+        except ROUTER_CONNECTION_ERRORS as e:
+            logger.warning("Can't audit address-list %s: %s", self.name, e)
+            return False
+        self.audit_bucket += len(buckets)
+        self.audit_differed += differed
+        self.audit_pass_repaired += len(self.commands)
+        if self.audit_pass_repaired > max(AUDIT_BUCKET_SIZE, len(self.addresses) * AUDIT_REPAIR_FRACTION):
+            logger.warning("Address-list %s: %d entries differ from the router, reloading the whole list", self.name,
+                           self.audit_pass_repaired)
+            self.commands = PendingOps()
+            self._start_audit_pass()
+            return True
+        if self.commands:
+            self.audit_repaired += len(self.commands)
+            self.commit()
+        if self.audit_bucket >= 1 << self.audit_prefix:
+            logger.info("Address-list %s audited: %d /%d buckets, %d repaired", self.name, 1 << self.audit_prefix,
+                        self.audit_prefix, self.audit_differed)
+            self._start_audit_pass()
+        return False
+
+    def _start_audit_pass(self):
+        self.audit_bucket = 0
+        self.audit_differed = 0
+        self.audit_pass_repaired = 0
+
+    def _audit_buckets(self, api, buckets):
+        # number of buckets that differed, their repairs are queued
+        differed = 0
+        for bucket in buckets:
+            shift = 32 - self.audit_prefix
+            low, high = bucket << shift, ((bucket + 1) << shift) - 1
+            queries = {'list': self.name.encode('utf-8')}
+            if low > 0:
+                queries['>address'] = int_to_ip(low - 1).encode('utf-8')
+            if high < 0xFFFFFFFF:
+                queries['<address'] = int_to_ip(high + 1).encode('utf-8')
+            found = {}
+            values = self.addresses.values
+            local = values[bisect.bisect_left(values, low):bisect.bisect_right(values, high)]
+            proplist = b'.id,address,timeout' if self.entry_timeout else b'.id,address'
+            try:
+                with ROUTER_RPC_SECONDS.time('print'):
+                    for entry in stream_print(api, '/ip/firewall/address-list', proplist, queries):
+                        try:
+                            address = ip_to_int(entry['address'].decode('utf-8'))
+                        except ValueError:
+                            continue  # prefixes of AggregatedIpset, ranges
+                        if not low <= address <= high:
+                            continue
+                        if 'timeout' in entry and address not in self.addresses:
+                            continue  # unblocked with --entry-timeout, left to expire
+                        found[address] = entry['id']
+            except routeros_api.exceptions.RouterOsApiCommunicationError as e:
+                logger.warning("Can't audit address-list %s: %s", self.name, e)
+                continue
+            self.audited += 1
+            # the .ids are fresh from the router either way
+            for address, entry_id in found.items():
+                self.index.add(self.name, address, entry_id)
+            remote = array.array('I', sorted(found))
+            if bucket_digest(local) == bucket_digest(remote):
+                AUDIT_BUCKETS.inc('match')
+                continue
+            AUDIT_BUCKETS.inc('repaired')
+            differed += 1
+            missing = sorted_difference(local, remote)
+            unexpected = sorted_difference(remote, local)
+            logger.warning("Address-list %s differs from the router in %s/%d: %d entries missing, %d unexpected",
+                           self.name, int_to_ip(low), self.audit_prefix, len(missing), len(unexpected))
+            for address in missing:
+                self.index.pop(self.name, address)
+                self.commands.append(OP_ADD, address)
+            for address in unexpected:
+                self.commands.append(OP_REMOVE, address)
+        return differed
+
+    def load_index(self):
+        # one listing of our address-list, afterwards removals don't need to list anything
+        count = self.router.call(self.index.load, self.name)
+        self.addresses = PackedAddressSet(self.index.addresses(self.name))
+        logger.debug("Loaded %d entries of address-list %s from router", count, self.name)
+        return count
+
+    def snapshot(self):
+        # (tracked addresses, index of our list) for Checkpoint
+        return self.addresses.values, self.index.snapshot(self.name)
+
+    def restore(self, addresses, index):
+        self.index.restore(self.name, *index)
+        self.addresses = PackedAddressSet(addresses)
+        self.commands = PendingOps()
+
+    def verify_index(self):
+        # cheap check that the router still has what the index says: entry count and a sample of ids
+        return self.router.call(self._verify_index)
+
+    def _verify_index(self, api):
+        resource = api.get_binary_resource('/ip/firewall/address-list')
+        with ROUTER_RPC_SECONDS.time('print'):
+            response = resource.call('print', {'count-only': b''}, {'list': self.name.encode('utf-8')})
+        count = int(response.done_message.get('ret', b'0'))
+        expected = self.index.count(self.name)
+        if count != expected:
+            logger.warning("Address-list %s has %d entries on the router, checkpoint has %d", self.name, count,
+                           expected)
+            return False
+        addresses, ids, _ = self.index.snapshot(self.name)
+        if not ids:
+            return True
+        sample = random.sample(range(len(ids)), min(CHECKPOINT_VERIFY_SAMPLE, len(ids)))
+        wanted = {'*{:X}'.format(ids[i]): int_to_ip(addresses[i]) for i in sample}
+        query = routeros_api.query.OrQuery(*[routeros_api.query.IsEqualQuery('.id', entry_id) for entry_id in wanted])
+        with ROUTER_RPC_SECONDS.time('print'):
+            found = resource.call('print', {'.proplist': b'.id,address,list'}, additional_queries=[query])
+        found = {row['id'].decode('utf-8'): (row['address'].decode('utf-8'), row['list'].decode('utf-8'))
+                 for row in found}
+        for entry_id, address in wanted.items():
+            if found.get(entry_id) != (address, self.name):
+                logger.warning("Address-list %s: %s on the router is %s, checkpoint has %s", self.name, entry_id,
+                               found.get(entry_id), address)
+                return False
+        return True
 
-    def delete_all_addresses(self):
-        connection = routeros_api.RouterOsApiPool(ip4, username=username, password=password, port=8728,
-                                                  plaintext_login=True)
-        api = connection.get_api()
-        list_queues = api.get_resource('/ip/firewall/address-list')
+    def reset(self):
+        self.commands = PendingOps()
+        self.addresses = PackedAddressSet()  # Reset tracked addresses
+
+    def get_addresses(self):
+        return [int_to_ip(address) for address in self.addresses]  # Return tracked addresses
+
+    def log_stats(self):
+        logger.info("Address-list %s: %d addresses tracked, %d ids indexed", self.name, len(self.addresses),
+                    len(self.index))
+        if self.entry_timeout:
+            logger.info("Address-list %s: %d entry timeouts refreshed", self.name, self.refreshed)
+        if self.audit_interval:
+            logger.info("Address-list %s: %d buckets audited, %d entries repaired", self.name, self.audited,
+                        self.audit_repaired)
+        if self.retries or self.retries.retried or self.retries.abandoned:
+            logger.info("Address-list %s: %d failed commands waiting for a retry, %d retried, %d given up",
+                        self.name, len(self.retries), self.retries.retried, self.retries.abandoned)
+        if self.controller is not None:
+            controller = self.controller
+            logger.info("Address-list %s: %d commands in flight (%d-%d), %.0f commands/s, latency %.1f ms "
+                        "(lowest %.1f ms), CPU load %s%%, %d increases, %d decreases, %d failed commands",
+                        self.name, controller.limit, controller.minimum, controller.maximum, controller.rate(),
+                        (controller.latency or 0.0) * 1000, (controller.latency_min or 0.0) * 1000,
+                        controller.cpu_load if controller.cpu_load is not None else '-', controller.increases,
+                        controller.decreases, controller.failed)
+
+
+class AggregatedIpset:
+    # Ipset-like sink collapsing dense blocks of blocked addresses into one prefix entry on the router.
+    # A block of --aggregate-prefix is pushed as a single prefix once at least `threshold` of its addresses
+    # are blocked (2 ** (32 - prefix) aggregates only completely blocked blocks) and is split back into
+    # single addresses as soon as one of its addresses is removed, so the removed address is not left covered.
+    # A split block stays split until the next LIST.
+    def __init__(self, ipset, prefix, threshold):
+        self.ipset = ipset
+        self.name = ipset.name
+        self.prefix = prefix
+        self.shift = 32 - prefix
+        self.threshold = max(1, min(threshold, 1 << self.shift))
+        self.regexp = re.compile(RE_IPV4)
+        self.addresses = PackedAddressSet()  # every blocked address, aggregated or not
+        self.counts = {}  # block -> number of blocked addresses in it
+        self.aggregated = set()  # blocks pushed as a prefix
+        self.split = set()  # blocks split by a removal, not aggregated again until the next LIST
+        self.aggregations = 0
+        self.splits = 0
+
+    @property
+    def commands(self):
+        return self.ipset.commands
+
+    @property
+    def router(self):
+        return self.ipset.router
+
+    @property
+    def retries(self):
+        return self.ipset.retries
+
+    @property
+    def index_verified(self):
+        return self.ipset.index_verified
+
+    @index_verified.setter
+    def index_verified(self, value):
+        self.ipset.index_verified = value
+
+    def network(self, block):
+        return '{}/{}'.format(int_to_ip(block << self.shift), self.prefix)
+
+    def _block_addresses(self, block):
+        values = self.addresses.values
+        low = bisect.bisect_left(values, block << self.shift)
+        high = bisect.bisect_left(values, (block + 1) << self.shift)
+        return values[low:high]
 
-        pole = list_queues.get()
-        for prvek in pole:
-            print(prvek)
-            list_queues.remove(id=prvek['id'])
+    def add_ip(self, ip):
+        if not isinstance(ip, int):
+            if not self.regexp.fullmatch(ip):
+                logger.warning("IP address skipped as it is not IPv4: %s", ip)
+                return
+            ip = ip_to_int(ip)
+        if ip in self.addresses:
+            return
+        self.addresses.add(ip)
+        block = ip >> self.shift
+        count = self.counts[block] = self.counts.get(block, 0) + 1
+        if block in self.aggregated:
+            return  # already covered by the prefix
+        if count >= self.threshold and block not in self.split:
+            # one prefix instead of the single addresses already on the router
+            self.ipset.add_network(self.network(block))
+            for address in self._block_addresses(block):
+                if address != ip:
+                    self.ipset.del_ip(address)
+            self.aggregated.add(block)
+            self.aggregations += 1
+        else:
+            self.ipset.add_ip(ip)
 
-            print(id)
-        connection.disconnect()
-        connection.disconnect()
+    def del_ip(self, ip):
+        if ip not in self.addresses:
+            logger.warning("IP address not found in the list: %s", ip)
+            return
+        ip = PackedAddressSet._key(ip)
+        self.addresses.discard(ip)
+        block = ip >> self.shift
+        count = self.counts[block] = self.counts[block] - 1
+        if not count:
+            del self.counts[block]
+        if block not in self.aggregated:
+            self.ipset.del_ip(ip)
+        else:
+            # split the prefix back into the addresses still blocked
+            for address in self._block_addresses(block):
+                self.ipset.add_ip(address)
+            self.ipset.del_network(self.network(block))
+            self.aggregated.discard(block)
+            self.split.add(block)
+            self.splits += 1
 
     def commit(self):
+        return self.ipset.commit()
+
+    def _aggregate(self, wanted):
+        # (addresses pushed one by one, prefixes) for the sorted array wanted
+        self.addresses = PackedAddressSet(wanted)
+        self.counts = {}
+        for address in wanted:
+            block = address >> self.shift
+            self.counts[block] = self.counts.get(block, 0) + 1
+        self.aggregated = {block for block, count in self.counts.items() if count >= self.threshold}
+        self.split = set()
+        single = array.array('I', (address for address in wanted if address >> self.shift not in self.aggregated))
+        return single, [self.network(block) for block in sorted(self.aggregated)]
+
+    def reconcile_chunks(self, chunks):
+        # aggregation needs the whole list
+        return self.reconcile(collect_addresses(chunks))
+
+    def reconcile(self, ips):
+        single, networks = self._aggregate(pack_addresses(ips))
+        result = self.ipset.reconcile(single, networks)
+        logger.info("LIST aggregated: %d addresses pushed as %d entries (%d /%d prefixes)", len(self.addresses),
+                    len(single) + len(networks), len(networks), self.prefix)
+        return result
+
+    def load_index(self):
+        return self.ipset.load_index()
+
+    def snapshot(self):
+        return self.addresses.values, self.ipset.index.snapshot(self.name)
+
+    def restore(self, addresses, index):
+        single, _ = self._aggregate(addresses)
+        self.ipset.restore(single, index)
+
+    def verify_index(self):
+        return self.ipset.verify_index()
+
+    def refresh(self):
+        self.ipset.refresh()
+
+    def audit(self):
+        # the single addresses are compared, prefix entries are left out
+        return self.ipset.audit()
+
+    def retry(self):
+        return self.ipset.retry()
+
+    def delete_all_addresses(self):
+        self.ipset.delete_all_addresses()
+        self._aggregate(array.array('I'))
+
+    def get_addresses(self):
+        return [int_to_ip(address) for address in self.addresses]
+
+    def log_stats(self):
+        logger.info("Address-list %s: %d addresses blocked by %d entries, %d /%d prefixes (%d aggregated, %d split)",
+                    self.name, len(self.addresses), len(self.ipset.addresses) + len(self.aggregated),
+                    len(self.aggregated), self.prefix, self.aggregations, self.splits)
+        self.ipset.log_stats()
+
+
+class DeviceWriter(threading.Thread):
+    # Applies the fanned-out changes to one router from its own thread and queue.
+    # Whenever the queue overflows or the router is unreachable the device is marked out of sync
+    # and later reconciled against the current snapshot instead of replaying everything it missed.
+    def __init__(self, fanout, name, router, list_name, queue_size, max_in_flight, aggregate=None,
+                 entry_timeout=ENTRY_TIMEOUT_DEFAULT, bulk_load=BULK_LOAD_DEFAULT, write_control=None,
+                 audit_interval=AUDIT_INTERVAL_DEFAULT, writer_sessions=WRITER_SESSIONS_DEFAULT):
+        super().__init__(name="device-" + name, daemon=True)
+        self.fanout = fanout
+        self.device_name = name
+        self.router = router
+        self.ipset = Ipset(list_name, router, max_in_flight=max_in_flight, entry_timeout=entry_timeout,
+                           bulk_load=bulk_load, write_control=write_control, audit_interval=audit_interval,
+                           writer_sessions=writer_sessions)
+        if aggregate is not None:
+            self.ipset = AggregatedIpset(self.ipset, *aggregate)
+        self.changes = queue.Queue(maxsize=queue_size)
+        self.needs_resync = True
+        self.applied_serial = 0
+        self.connected = False
+        self.stopping = threading.Event()
+
+    def push(self, changes, serial):
+        # called with fanout.lock held
+        if self.needs_resync:
+            return
         try:
-            # Create a connection to the RouterOS device
-            connection = routeros_api.RouterOsApiPool(ip4, username=username, password=password, port=8728,
-                                                      plaintext_login=True)
-            api = connection.get_api()
+            self.changes.put_nowait((changes, serial))
+        except queue.Full:
+            logger.warning("%s: too many pending changes, will resynchronize the whole list", self.device_name)
+            self.needs_resync = True
 
-            # Iterate over the commands and send them to the RouterOS device
-            for cmd in self.commands:
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        delay = 1
+        while not self.stopping.is_set():
+            try:
+                if self.needs_resync:
+                    self._resync()
                 try:
-                    parts = cmd.split()
-                    if len(parts) == 3 and parts[0] in ['add', 'remove']:
-                        ip_address = parts[2]
-                        action = 'add' if parts[0] == 'add' else 'remove'
-
-                        # Send the command to the RouterOS device
-                        api.get_binary_resource('/ip/firewall/address-list').call(action, {
-                            'address': ip_address.encode('utf-8'),  # Encode as bytes
-                            'list': self.name.encode('utf-8')  # Encode as bytes
-                        })
-                except routeros_api.exceptions.RouterOsApiCommunicationError as e:
-                    if "failure: already have such entry" in str(e):
-                        logger.warning("Address already exists in the list: %s", cmd)
-                    elif "failure: entry not found" in str(e):
-                        logger.warning("Address not found in the list: %s", cmd)
-                    else:
-                        logger.error("Error modifying address list: %s", str(e))
+                    item = self.changes.get(timeout=1)
+                except queue.Empty:
+                    self.ipset.refresh()
+                    self.ipset.retry()
+                    if self.ipset.audit():
+                        self.needs_resync = True
+                    continue
+                if item is None or self.needs_resync:
+                    continue
+                changes, serial = item
+                for ip, blocked in changes.items():
+                    if blocked and ip not in self.ipset.addresses:
+                        self.ipset.add_ip(ip)
+                    elif not blocked and ip in self.ipset.addresses:
+                        self.ipset.del_ip(ip)
+                if not self.ipset.commit():
+                    raise routeros_api.exceptions.RouterOsApiConnectionError("commit failed")
+                self.applied_serial = serial
+                self.connected = True
+                delay = 1
+                self.ipset.refresh()
+            except ROUTER_CONNECTION_ERRORS + (routeros_api.exceptions.RouterOsApiError,) as e:
+                # a !trap outside a single command (login refused, failed print) is retried like a lost connection
+                logger.warning("%s: router unreachable or refusing commands (next try after %d sec): %s",
+                               self.device_name, delay, e)
+                self.connected = False
+                self.needs_resync = True
+                self.stopping.wait(delay)
+                delay = min(delay * 2, 120)
+
+    def _resync(self):
+        with self.fanout.lock:
+            # everything queued so far is contained in the snapshot
+            wanted = array.array('I', self.fanout.addresses.values)
+            serial = self.fanout.current_serial()
+            while not self.changes.empty():
+                self.changes.get_nowait()
+            self.needs_resync = False
+        try:
+            self.ipset.reconcile(wanted)
+        except ROUTER_CONNECTION_ERRORS:
+            self.needs_resync = True
+            raise
+        if self.ipset.commands:
+            self.needs_resync = True
+            raise routeros_api.exceptions.RouterOsApiConnectionError("reconcile failed")
+        self.applied_serial = serial
+        self.connected = True
+
+    def log_stats(self):
+        logger.info("%s (%s): %s, serial %d, %d pending batches, %d addresses", self.device_name, self.router.host,
+                    "in sync" if self.connected and not self.needs_resync else "out of sync", self.applied_serial,
+                    self.changes.qsize(), len(self.ipset.addresses))
+
+
+class DeviceFanout:
+    # Ipset-like sink fanning the same changes out to many routers. It keeps the authoritative set of
+    # blocked addresses and every router applies it from its own DeviceWriter thread.
+    def __init__(self, name, devices, queue_size=QUEUE_SIZE_DEFAULT, max_in_flight=MAX_IN_FLIGHT_DEFAULT,
+                 sessions=ROUTER_SESSIONS_DEFAULT, aggregate=None, entry_timeout=ENTRY_TIMEOUT_DEFAULT,
+                 bulk_load=BULK_LOAD_DEFAULT, write_control=None, audit_interval=AUDIT_INTERVAL_DEFAULT,
+                 writer_sessions=WRITER_SESSIONS_DEFAULT):
+        self.name = name
+        self.regexp = re.compile(RE_IPV4)
+        self.addresses = PackedAddressSet()
+        self.pending = {}
+        self.serial = None
+        self.lock = threading.Lock()
+        self.writers = []
+        for device in devices:
+            router = RouterConnection(device["host"], device.get("username", username), device.get("password", password),
+                                      device.get("port", api_port), sessions=max(sessions, writer_sessions))
+            self.writers.append(DeviceWriter(self, device.get("name", device["host"]), router, name, queue_size,
+                                             max_in_flight, aggregate, entry_timeout, bulk_load, write_control,
+                                             audit_interval, writer_sessions))
+
+    def start(self):
+        for writer in self.writers:
+            writer.start()
+
+    def close(self):
+        for writer in self.writers:
+            writer.stop()
+        for writer in self.writers:
+            writer.join()
+            writer.router.close()
+
+    def current_serial(self):
+        return self.serial.current_serial if self.serial is not None else 0
 
-            self.commands = []  # Reset commands
+    def add_ip(self, ip):
+        if isinstance(ip, int) or self.regexp.fullmatch(ip):
+            address = ip if isinstance(ip, int) else ip_to_int(ip)
+            with self.lock:
+                self.addresses.add(address)
+                self.pending[address] = True
+        else:
+            logger.warning("IP address skipped as it is not IPv4: %s", ip)
 
-            print("Commit called. Sending commands to MikroTik firewall.")
+    def del_ip(self, ip):
+        address = PackedAddressSet._key(ip)
+        if address is None:
+            logger.warning("IP address not found in the list: %s", ip)
+            return
+        with self.lock:
+            self.addresses.discard(address)
+            self.pending[address] = False
 
-        except (PermissionError, FileNotFoundError) as e:
-            logger.critical("Can't run ipset command: %s.", str(e))
-            print("Can't run ipset command: {}.".format(str(e)), file=sys.stderr)
-            sys.exit(1)
-        except OSError as e:
-            logger.warning("Error running ipset command: %s.", str(e))
-        finally:
-            if connection:
-                connection.disconnect()
+    def commit(self):
+        with self.lock:
+            if self.pending:
+                for writer in self.writers:
+                    writer.push(self.pending, self.current_serial())
+                self.pending = {}
+        return True
+
+    def reconcile_chunks(self, chunks):
+        return self.reconcile(collect_addresses(chunks))
+
+    def reconcile(self, ips):
+        wanted = PackedAddressSet(pack_addresses(ips))
+        with self.lock:
+            self.addresses = wanted
+            self.pending = {}
+            self._resync_all()
+        logger.info("LIST fanned out to %d routers, %d addresses", len(self.writers), len(wanted))
 
-    def reset(self):
-        self.commands.append('create {} hash:ip family inet hashsize 1024 maxelem 65536\n'.format(self.name))
-        self.commands.append('flush {}\n'.format(self.name))
-        self.addresses = set()  # Reset tracked addresses
+    def delete_all_addresses(self):
+        # routers resynchronize against whatever the list is filled with afterwards
+        with self.lock:
+            self.addresses = PackedAddressSet()
+            self.pending = {}
+            self._resync_all()
 
-    def get_addresses(self):
-        return list(self.addresses)  # Return tracked addresses
+    def refresh(self):
+        pass  # every DeviceWriter refreshes its own router
+
+    def audit(self):
+        return False  # every DeviceWriter audits its own router
+
+    def retry(self):
+        pass  # every DeviceWriter replays its own failed commands
+
+    def _resync_all(self):
+        for writer in self.writers:
+            writer.needs_resync = True
+            try:
+                writer.changes.put_nowait(None)  # wake the writer up
+            except queue.Full:
+                pass  # busy writer checks needs_resync before its next batch
+
+    def log_stats(self):
+        for writer in self.writers:
+            writer.log_stats()
+
+
+def load_devices_file(path):
+    # JSON list of {"name": ..., "host": ..., "port": 8728, "username": ..., "password": ...}
+    with open(path, encoding="utf-8") as filef:
+        devices = json.load(filef)
+    for device in devices:
+        if "host" not in device:
+            raise ValueError("device without host in {}: {}".format(path, device))
+    return devices
+
+
+def load_devices_db(path):
+    # Machine rows of the PMikrotik web application which have the router API address filled in
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute(
+            "SELECT name, ip, api_port, api_username, api_password FROM machine WHERE ip IS NOT NULL AND ip != ''"
+        ).fetchall()
+    finally:
+        connection.close()
+    devices = []
+    for name, host, port, user, secret in rows:
+        device = {"name": name, "host": host, "port": port or api_port}
+        if user:
+            device["username"] = user
+        if secret is not None:
+            device["password"] = secret
+        devices.append(device)
+    return devices
 
 
 def create_zmq_socket(context, server_public_file):
@@ -211,9 +2130,12 @@ class InvalidMsgError(Exception):
     pass
 
 
-def parse_msg(data):
+def parse_msg(data, stream_list=False):
+    # with stream_list the payload of a LIST message is a ListMessage decoded later
     try:
         msg_type = str(data[0], encoding="UTF-8")
+        if stream_list and msg_type == TOPIC_DYNFW_LIST:
+            return msg_type, ListMessage(bytes(data[1]))
         payload = msgpack.unpackb(data[1], raw=False)
     except IndexError:
         raise InvalidMsgError("Not enough parts in message")
@@ -222,96 +2144,670 @@ def parse_msg(data):
     return msg_type, payload
 
 
+class ListMessage:
+    # LIST payload kept as msgpack bytes. scan() reads the other keys skipping over the addresses and
+    # chunks() then decodes the addresses a chunk at a time, so the whole list never exists as Python objects
+    # and router writes can start before it is decoded.
+    def __init__(self, data, chunk_size=LIST_CHUNK_SIZE):
+        self.data = data
+        self.chunk_size = max(1, chunk_size)
+        self.fields = None
+        self.size = 0
+
+    def _unpacker(self):
+        return msgpack.Unpacker(io.BytesIO(self.data), raw=False, read_size=LIST_READ_SIZE)
+
+    def scan(self):
+        if self.fields is not None:
+            return
+        fields = {}
+        try:
+            unpacker = self._unpacker()
+            for _ in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if key == "list":
+                    self.size = unpacker.read_array_header()
+                    for _ in range(self.size):
+                        unpacker.skip()
+                    fields[key] = None
+                else:
+                    fields[key] = unpacker.unpack()
+        except (ValueError, TypeError, msgpack.exceptions.UnpackException, UnicodeDecodeError) as e:
+            raise InvalidMsgError("Broken message: {}".format(e))
+        self.fields = fields
+
+    def __contains__(self, key):
+        self.scan()
+        return key in self.fields
+
+    def __getitem__(self, key):
+        self.scan()
+        return self.fields[key]
+
+    def chunks(self):
+        # lists of at most chunk_size entries of "list", the structure has been checked by scan() but the
+        # entries only here: a chunk is fully decoded before it is handed over, so nothing of a broken one
+        # reaches the router
+        unpacker = self._unpacker()
+        for _ in range(unpacker.read_map_header()):
+            if unpacker.unpack() != "list":
+                unpacker.skip()
+                continue
+            remaining = unpacker.read_array_header()
+            while remaining:
+                count = min(self.chunk_size, remaining)
+                try:
+                    chunk = [unpacker.unpack() for _ in range(count)]
+                except (ValueError, TypeError, msgpack.exceptions.UnpackException, UnicodeDecodeError) as e:
+                    raise InvalidMsgError("Broken message: {}".format(e))
+                yield chunk
+                remaining -= count
+
+
+class DeltaBatcher:
+    # Accumulates delta updates for up to `window` seconds or `max_size` addresses and commits only the net change:
+    # add+remove of the same IP within the window cancel out and repeated deltas are deduplicated.
+    def __init__(self, ipset, window=DELTA_BATCH_WINDOW_DEFAULT, max_size=DELTA_BATCH_SIZE_DEFAULT):
+        self.ipset = ipset
+        self.window = window
+        self.max_size = max(1, max_size)
+        self.pending = {}  # ip -> True when it should end up blocked, False when unblocked
+        self.received = 0
+        self.first_received = None
+        self.batches_flushed = 0
+        self.ops_received = 0
+        self.ops_coalesced = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def add_ip(self, ip):
+        self._push(ip, True)
+
+    def del_ip(self, ip):
+        self._push(ip, False)
+
+    def _push(self, ip, blocked):
+        if not self.pending:
+            self.first_received = time.monotonic()
+        self.pending[ip] = blocked
+        self.received += 1
+        if len(self.pending) >= self.max_size or self.window <= 0:
+            self.flush()
+
+    def time_to_flush(self):
+        # seconds until the pending batch is due, None when nothing is pending
+        if not self.pending:
+            return None
+        return max(0.0, self.first_received + self.window - time.monotonic())
+
+    def flush_if_due(self):
+        if self.pending and self.time_to_flush() <= 0:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        applied = 0
+        for ip, blocked in self.pending.items():
+            if blocked and ip not in self.ipset.addresses:
+                self.ipset.add_ip(ip)
+                applied += 1
+            elif not blocked and ip in self.ipset.addresses:
+                self.ipset.del_ip(ip)
+                applied += 1
+        latency = time.monotonic() - self.first_received  # how long the oldest delta waited in the window
+        self.ipset.commit()
+        self.batches_flushed += 1
+        self.ops_received += self.received
+        self.ops_coalesced += self.received - applied
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        logger.debug("Delta batch flushed: %d deltas -> %d router operations, waited %.3f s",
+                     self.received, applied, latency)
+        self.discard()
+
+    def discard(self):
+        # drop pending deltas - used when a full LIST supersedes them
+        self.pending = {}
+        self.received = 0
+        self.first_received = None
+
+    def stats(self):
+        return {
+            "batches_flushed": self.batches_flushed,
+            "ops_received": self.ops_received,
+            "ops_coalesced": self.ops_coalesced,
+            "latency_avg": self.latency_total / self.batches_flushed if self.batches_flushed else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info("Delta batching: %d batches flushed, %d of %d deltas coalesced, added latency avg %.3f s "
+                    "max %.3f s", stats["batches_flushed"], stats["ops_coalesced"], stats["ops_received"],
+                    stats["latency_avg"], stats["latency_max"])
+
+
 class Serial:
-    def __init__(self, missing_limit):
-        self.missing_limit = missing_limit
-        self.received_out_of_order = set()
+    # Windowed serial tracker. Deltas arriving ahead of a missing serial are held in a ring buffer of `window`
+    # slots and released in serial order once the gap fills. A gap not filled within gap_timeout seconds,
+    # a delta beyond the window or a lower serial which is not a duplicate of one recently applied
+    # (restarted server) means the list has to be reloaded.
+    def __init__(self, window, gap_timeout=SERIAL_GAP_TIMEOUT_DEFAULT):
+        self.window = window
+        self.gap_timeout = gap_timeout
+        self.slots = [None] * window  # (serial, item) at serial % window
+        self.applied = array.array('q', [-1]) * window  # serial applied at serial % window
+        self.held = 0
         self.current_serial = 0
-
-    def update_ok(self, serial):
-        # update serial & return bool
-        # return whether the serial is ok or if the list should be reloaded
-        if serial == self.current_serial + 1:
-            # received expected serial
-            self.current_serial = serial
-            while self.current_serial + 1 in self.received_out_of_order:
-                # rewind serials
-                self.current_serial = self.current_serial + 1
-                self.received_out_of_order.remove(self.current_serial)
-            return True
-        else:
-            if serial < self.current_serial:
+        self.synchronized = False  # no LIST applied yet or reload requested
+        self.gap_since = None
+        self.reordered = 0
+        self.stale = 0
+
+    def push(self, serial, item):
+        # items ready to be applied in serial order, None when the list has to be reloaded
+        if not self.synchronized:
+            self._hold(serial, item)  # the next LIST tells which of them are still needed
+            return []
+        if serial <= self.current_serial:
+            if self.applied[serial % self.window] != serial:
                 logger.debug("received lower serial (restarted server?)")
-                return False
-            if len(self.received_out_of_order) > self.missing_limit:
-                logger.debug("too many missed messages")
-                print("Moc messages v hajzlu nevim co delat")
-                return False
-            self.received_out_of_order.add(serial)
-            return True
+                return None
+            self.stale += 1  # duplicate of an applied delta or of the last list
+            return []
+        if serial - self.current_serial > self.window:
+            logger.debug("too many missed messages")
+            return None
+        if serial != self.current_serial + 1:
+            self._hold(serial, item)
+            if self.gap_since is None:
+                self.gap_since = time.monotonic()
+                SERIAL_GAPS.inc()
+            return []
+        self.current_serial = serial
+        self.applied[serial % self.window] = serial
+        return [item] + self._release()
+
+    def _hold(self, serial, item):
+        slot = serial % self.window
+        if self.slots[slot] is None:
+            self.held += 1
+        self.slots[slot] = (serial, item)
+
+    def _release(self):
+        ready = []
+        while self.held:
+            slot = (self.current_serial + 1) % self.window
+            if self.slots[slot] is None or self.slots[slot][0] != self.current_serial + 1:
+                break
+            ready.append(self.slots[slot][1])
+            self.slots[slot] = None
+            self.held -= 1
+            self.current_serial += 1
+            self.applied[slot] = self.current_serial
+        if ready:
+            self.reordered += len(ready)
+        # waiting for the next missing serial starts now
+        self.gap_since = time.monotonic() if self.held else None
+        return ready
+
+    def gap_expired(self):
+        return (self.synchronized and self.gap_since is not None
+                and time.monotonic() - self.gap_since > self.gap_timeout)
+
+    def request_reload(self):
+        # deltas are held until reset() by the next LIST
+        self.synchronized = False
+        self.gap_since = None
 
     def reset(self, serial):
-        # reset serial - after list reload
-        self.received_out_of_order = set()
+        # reset serial - after list reload, returns the held deltas following the list
         self.current_serial = serial
+        self.synchronized = True
+        # only the list serial itself counts as applied, anything lower is a restarted server
+        self.applied = array.array('q', [-1]) * self.window
+        self.applied[serial % self.window] = serial
+        for slot, held in enumerate(self.slots):
+            if held is not None and not serial < held[0] <= serial + self.window:
+                self.slots[slot] = None
+                self.held -= 1
+        return self._release()
+
+
+class Checkpoint:
+    # Applied state saved for warm restarts: the last applied serial, the tracked addresses, the
+    # address -> .id index of our address-list and the commands waiting for a retry. Fixed header followed
+    # by little-endian 32-bit arrays, so the file can be memory-mapped and read without parsing. Written to
+    # a temporary file and renamed over the old one, a crash never leaves a half written checkpoint.
+    HEADER = struct.Struct('<8sIQdIIIII')  # magic, version, serial, saved at, name, addresses, ids, json, crc32
+    MAGIC = b'DYNFWCP\x00'
+    VERSION = 1
+
+    def __init__(self, path, interval=CHECKPOINT_INTERVAL_DEFAULT):
+        self.path = path
+        self.interval = interval
+        self.saved_serial = None
+        self.saved_at = 0.0
+
+    def due(self, serial):
+        return serial != self.saved_serial and time.monotonic() - self.saved_at >= self.interval
+
+    def save(self, ipset, serial):
+        addresses, (index_addresses, index_ids, other) = ipset.snapshot()
+        name = ipset.name.encode('utf-8')
+        extra = json.dumps({"other": other, "retries": ipset.retries.snapshot()}).encode('utf-8')
+        body = [name + b'\0' * (-len(name) % 4)]
+        for values in (addresses, index_addresses, index_ids):
+            if sys.byteorder != 'little':
+                values = array.array('I', values)
+                values.byteswap()
+            body.append(values.tobytes())
+        body.append(extra)
+        crc = 0
+        for part in body:
+            crc = zlib.crc32(part, crc)
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, serial, time.time(), len(name), len(addresses),
+                                  len(index_ids), len(extra), crc)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(header)
+            for part in body:
+                f.write(part)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self.saved_serial = serial
+        self.saved_at = time.monotonic()
+        logger.debug("Checkpoint saved: serial %d, %d addresses, %d ids", serial, len(addresses), len(index_ids))
+
+    def load(self, list_name):
+        # (serial, addresses, index, retries) or None when there is no usable checkpoint for list_name
+        try:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return self._parse(data, list_name)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning("Can't read checkpoint %s: %s", self.path, e)
+            return None
+
+    def _parse(self, data, list_name):
+        magic, version, serial, saved_at, name_size, address_count, id_count, extra_size, crc = \
+            self.HEADER.unpack_from(data)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("not a checkpoint file")
+        offset = self.HEADER.size
+        end = offset + name_size + (-name_size % 4) + 4 * (address_count + 2 * id_count) + extra_size
+        if len(data) != end or zlib.crc32(data[offset:end]) != crc:
+            raise ValueError("checkpoint file is damaged")
+        name = data[offset:offset + name_size].decode('utf-8')
+        if name != list_name:
+            logger.info("Checkpoint %s is for address-list %s, ignoring it", self.path, name)
+            return None
+        offset += name_size + (-name_size % 4)
+        arrays = []
+        for count in (address_count, id_count, id_count):
+            values = array.array('I')
+            values.frombytes(data[offset:offset + 4 * count])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            arrays.append(values)
+            offset += 4 * count
+        extra = json.loads(data[offset:end].decode('utf-8'))
+        other = [tuple(entry) for entry in extra["other"]]
+        retries = extra["retries"]
+        logger.info("Checkpoint %s: serial %d, %d addresses, %d commands to retry, saved %s", self.path, serial,
+                    address_count, len(retries), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(saved_at)))
+        self.saved_serial = serial
+        return serial, arrays[0], (arrays[1], arrays[2], other), retries
 
 
 class DynfwList:
-    def __init__(self, socket, dynfw_ipset_name, api):
+    def __init__(self, socket, dynfw_ipset_name, router, reconcile=True, batch_window=DELTA_BATCH_WINDOW_DEFAULT,
+                 batch_size=DELTA_BATCH_SIZE_DEFAULT, max_in_flight=MAX_IN_FLIGHT_DEFAULT, ipset=None,
+                 serial_window=MISSING_UPDATE_CNT_LIMIT, gap_timeout=SERIAL_GAP_TIMEOUT_DEFAULT, checkpoint=None,
+                 entry_timeout=ENTRY_TIMEOUT_DEFAULT, bulk_load=BULK_LOAD_DEFAULT, write_control=None,
+                 audit_interval=AUDIT_INTERVAL_DEFAULT, writer_sessions=WRITER_SESSIONS_DEFAULT):
         self.socket = socket
-        self.serial = Serial(MISSING_UPDATE_CNT_LIMIT)
-        self.ipset = Ipset(dynfw_ipset_name)
+        self.serial = Serial(serial_window, gap_timeout)
+        self.reloads = 0
+        self.checkpoint = checkpoint
+        self.router = router
+        self.reconcile = reconcile
+        # ipset may be any sink with the Ipset interface, e.g. DeviceFanout for many routers
+        self.ipset = ipset if ipset is not None else Ipset(dynfw_ipset_name, router, max_in_flight=max_in_flight,
+                                                           entry_timeout=entry_timeout, bulk_load=bulk_load,
+                                                           write_control=write_control,
+                                                           audit_interval=audit_interval,
+                                                           writer_sessions=writer_sessions)
+        self.batcher = DeltaBatcher(self.ipset, batch_window, batch_size)
         self.socket.setsockopt(zmq.SUBSCRIBE, TOPIC_DYNFW_LIST.encode('utf-8'))
-        self.api = api
 
     def handle_delta(self, msg):
         for key in REQUIRED_DELTA_KEYS:
             if key not in msg:
                 raise InvalidMsgError("missing delta key {}".format(key))
-        if not self.serial.update_ok(msg["serial"]):
-            logger.debug("Serial out of order, skipping delta update")
+        ready = self.serial.push(msg["serial"], msg)
+        if ready is None:
+            logger.warning("Serial %d out of the window after %d, reloading the list", msg["serial"],
+                           self.serial.current_serial)
+            self.reload_list('window')
             return
+        for delta in ready:
+            self.apply_delta(delta)
+
+    def apply_delta(self, msg):
         if msg["delta"] == "positive":
-            self.ipset.add_ip(msg["ip"])
+            self.batcher.add_ip(msg["ip"])
             logger.debug("DELTA message: +%s, serial %d", msg["ip"], msg["serial"])
         elif msg["delta"] == "negative":
-            self.remove_ips(msg["ip"])
+            self.batcher.del_ip(msg["ip"])
             logger.debug("DELTA message: -%s, serial %d", msg["ip"], msg["serial"])
-        self.ipset.commit()
 
-    def remove_ips(self, ips_to_remove):
-        list_resource = self.api.get_resource('/ip/firewall/address-list')
-        ip_to_delete = ips_to_remove
+    def reload_list(self, reason):
+        # deltas stay subscribed and are held until the LIST arrives
+        self.serial.request_reload()
+        self.reloads += 1
+        LIST_RELOADS.inc(reason)
+        self.socket.setsockopt(zmq.SUBSCRIBE, TOPIC_DYNFW_LIST.encode('utf-8'))
 
-        # Get the list of addresses from the RouterOS device
-        address_list = list_resource.get()
+    def poll_timeout(self, default):
+        # how long (ms) the main loop may block waiting for a message
+        time_to_flush = self.batcher.time_to_flush()
+        if time_to_flush is None:
+            return default
+        return min(default, int(time_to_flush * 1000) + 1)
+
+    def idle(self):
+        # housekeeping between messages
+        self.batcher.flush_if_due()
+        if self.serial.synchronized:
+            self.ipset.refresh()
+            self.ipset.retry()
+            if self.ipset.audit():
+                self.reload_list('audit')
+        if self.serial.gap_expired():
+            logger.warning("Delta serial %d missing for %d s, reloading the list", self.serial.current_serial + 1,
+                           self.serial.gap_timeout)
+            self.reload_list('gap')
+        if self.checkpoint is not None and self.checkpoint.due(self.serial.current_serial):
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        # only a state fully written to the router is saved
+        if not self.serial.synchronized or self.batcher.pending or self.ipset.commands:
+            return
+        try:
+            self.checkpoint.save(self.ipset, self.serial.current_serial)
+        except OSError as e:
+            logger.warning("Can't save checkpoint %s: %s", self.checkpoint.path, e)
+            self.checkpoint.saved_at = time.monotonic()
+
+    def resume(self):
+        # continue from the checkpoint with deltas only, if the router still has what it says
+        state = self.checkpoint.load(self.ipset.name)
+        if state is None:
+            return False
+        serial, addresses, index, retries = state
+        self.ipset.restore(addresses, index)
+        try:
+            verified = self.ipset.verify_index()
+        except ROUTER_CONNECTION_ERRORS as e:
+            logger.error("Can't reach RouterOS API to verify the checkpoint: %s", str(e))
+            verified = False
+        if not verified:
+            logger.warning("Router doesn't match the checkpoint, waiting for the full list")
+            return False
+        self.ipset.index_verified = True  # next LIST doesn't have to list the router again
+        self.ipset.retries.restore(retries)
+        self.serial.reset(serial)
+        self.socket.setsockopt(zmq.UNSUBSCRIBE, TOPIC_DYNFW_LIST.encode('utf-8'))
+        self.socket.setsockopt(zmq.SUBSCRIBE, TOPIC_DYNFW_DELTA.encode('utf-8'))
+        logger.info("Resumed from checkpoint at serial %d with %d addresses", serial, len(self.ipset.addresses))
+        return True
 
-        # Find the index of the IP address to delete
-        index_to_delete = next((i for i, item in enumerate(address_list) if item['address'] == ip_to_delete), None)
-
-        # If the IP address is found, proceed with removal
-        if index_to_delete is not None:
-            id_to_delete = address_list[index_to_delete]['id']
-            list_resource.remove(id=id_to_delete)
-            print(f"Removed IP {ip_to_delete} from the address list")
-        else:
-            logger.warning("IP address not found in the list: %s", ip_to_delete)
+    def log_stats(self):
+        logger.info("Serial %d: %d deltas held, %d applied after reordering, %d stale, %d list reloads",
+                    self.serial.current_serial, self.serial.held, self.serial.reordered, self.serial.stale,
+                    self.reloads)
+        self.batcher.log_stats()
+        self.ipset.log_stats()
 
     def handle_list(self, msg):
         for key in REQUIRED_LIST_KEYS:
             if key not in msg:
                 raise InvalidMsgError("missing list key {}".format(key))
-        self.serial.reset(msg["serial"])
-        self.ipset.delete_all_addresses()  # Delete all addresses before filling the list
-        for ip in msg["list"]:
-            self.ipset.add_ip(ip)
-        self.ipset.commit()
-        logger.debug("LIST message - %s addresses, serial %d", len(msg["list"]), msg["serial"])
+        following = self.serial.reset(msg["serial"])  # deltas held while waiting for the list
+        self.batcher.discard()  # full list supersedes not yet flushed deltas
+        if isinstance(msg, ListMessage):
+            size, chunks = msg.size, msg.chunks()
+        else:
+            size, chunks = len(msg["list"]), [msg["list"]]
+        try:
+            if self.reconcile:
+                # apply only the difference against what is already on the router
+                self.ipset.reconcile_chunks(chunks)
+            else:
+                self.ipset.delete_all_addresses()  # Delete all addresses before filling the list
+                ingest = ListIngest()
+                for chunk in chunks:
+                    for address in ingest.add(chunk):
+                        self.ipset.add_ip(address)
+                    self.ipset.commit()
+                ingest.finish()
+        except ROUTER_CONNECTION_ERRORS as e:
+            # stay subscribed to the list, the next LIST message is another try
+            logger.error("Can't reach RouterOS API to apply LIST message: %s", str(e))
+            self.serial.request_reload()
+            LIST_RELOADS.inc('router')
+            return
+        except InvalidMsgError:
+            # a broken entry further in the list, what was applied before it is reconciled by the next LIST
+            self.serial.request_reload()
+            LIST_RELOADS.inc('invalid')
+            raise
+        logger.debug("LIST message - %s addresses, serial %d", size, msg["serial"])
         self.socket.setsockopt(zmq.UNSUBSCRIBE, TOPIC_DYNFW_LIST.encode('utf-8'))
         self.socket.setsockopt(zmq.SUBSCRIBE, TOPIC_DYNFW_DELTA.encode('utf-8'))
+        for delta in following:
+            self.apply_delta(delta)
+        if self.checkpoint is not None:
+            self.batcher.flush()
+            self.save_checkpoint()
+
+
+class FeedRecorder:
+    # Writes every received multipart message to a file for benchmarks/feed_replay.py:
+    # header, then per message seconds since the start, number of frames and the length-prefixed frames
+    HEADER = struct.Struct('<8sI')
+    RECORD = struct.Struct('<dH')
+    FRAME = struct.Struct('<I')
+    MAGIC = b'DYNFWREC'
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+        self.started = time.monotonic()
+        self.records = 0
+
+    def write(self, frames):
+        parts = [self.RECORD.pack(time.monotonic() - self.started, len(frames))]
+        for frame in frames:
+            parts.append(self.FRAME.pack(len(frame)))
+            parts.append(frame)
+        self.file.write(b"".join(parts))
+        self.records += 1
+
+    def close(self):
+        self.file.close()
+        logger.info("Recorded %d messages to %s", self.records, self.path)
+
+
+def read_recording(path):
+    # (seconds since the start, frames) of every message written by FeedRecorder
+    with open(path, 'rb') as f:
+        header = f.read(FeedRecorder.HEADER.size).ljust(FeedRecorder.HEADER.size, b'\0')
+        magic, version = FeedRecorder.HEADER.unpack(header)
+        if magic != FeedRecorder.MAGIC or version != FeedRecorder.VERSION:
+            raise ValueError("{} is not a dynfw recording".format(path))
+        while True:
+            record = f.read(FeedRecorder.RECORD.size)
+            if len(record) < FeedRecorder.RECORD.size:
+                return  # end of the file, or the recording was cut off mid-message
+            offset, count = FeedRecorder.RECORD.unpack(record)
+            frames = []
+            for _ in range(count):
+                length = f.read(FeedRecorder.FRAME.size)
+                if len(length) < FeedRecorder.FRAME.size:
+                    return
+                length, = FeedRecorder.FRAME.unpack(length)
+                frame = f.read(length)
+                if len(frame) < length:
+                    return
+                frames.append(frame)
+            yield offset, frames
+
+
+class FeedReceiver(threading.Thread):
+    # Receives and decodes dynfw messages only, router writes happen in RouterWriter.
+    # ZMQ sockets are not thread safe, so subscription changes requested by other threads
+    # are queued here and applied by the receiver thread itself.
+    def __init__(self, socket, messages, policy=QUEUE_POLICY_DEFAULT, recorder=None):
+        super().__init__(name="dynfw-receiver", daemon=True)
+        self.socket = socket
+        self.messages = messages
+        self.policy = policy
+        self.recorder = recorder
+        self.socket_options = queue.Queue()
+        self.dropped = 0
+        self.dropping = False  # deltas are being dropped since the queue got full
+        self.reload_requested = threading.Event()  # the full list is needed, requested by the RouterWriter
+        self.running = True
+
+    def setsockopt(self, option, value):
+        self.socket_options.put((option, value))
+
+    def stop(self):
+        self.running = False
+
+    def _apply_socket_options(self):
+        while True:
+            try:
+                option, value = self.socket_options.get_nowait()
+            except queue.Empty:
+                return
+            self.socket.setsockopt(option, value)
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        last_message_time = time.monotonic()
+        while self.running:
+            self._apply_socket_options()
+            if not poller.poll(RECEIVER_POLL_INTERVAL):
+                if time.monotonic() - last_message_time >= POLL_TIMEOUT / 1000:
+                    print("No message received within the timeout.")
+                    last_message_time = time.monotonic()
+                continue
+            data = self.socket.recv_multipart()
+            last_message_time = time.monotonic()
+            if self.recorder is not None:
+                self.recorder.write(data)
+            try:
+                topic, payload = parse_msg(data, stream_list=True)
+            except InvalidMsgError as e:
+                logger.warning("Invalid message received: %s", e)
+                PARSE_FAILURES.inc()
+                continue
+            MESSAGES_RECEIVED.inc(topic)
+            self._enqueue((topic, payload, last_message_time))
 
-
-def parse_args():
+    def _enqueue(self, item):
+        if self.policy == 'drop' and item[0] == TOPIC_DYNFW_DELTA:
+            try:
+                self.messages.put_nowait(item)
+                self.dropping = False
+            except queue.Full:
+                # the delta is lost, so the router state can't be trusted anymore - ask for the full list,
+                # once for the whole run of dropped deltas
+                if not self.dropping:
+                    logger.warning("Message queue full, dropping deltas and requesting full list")
+                    self.dropping = True
+                    self.reload_requested.set()
+                self.dropped += 1
+                DELTAS_DROPPED.inc()
+            return
+        # block - let the messages pile up in ZMQ until the writer catches up
+        while self.running:
+            try:
+                self.messages.put(item, timeout=RECEIVER_POLL_INTERVAL / 1000)
+                return
+            except queue.Full:
+                self._apply_socket_options()
+
+
+class RouterWriter(threading.Thread):
+    # Takes decoded messages from the queue and applies them to the router
+    def __init__(self, dynfw_list, messages, receiver=None):
+        super().__init__(name="router-writer", daemon=True)
+        self.dynfw_list = dynfw_list
+        self.messages = messages
+        self.receiver = receiver
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        last_stats_time = time.monotonic()
+        while self.running:
+            timeout = self.dynfw_list.poll_timeout(WRITER_IDLE_TIMEOUT) / 1000
+            try:
+                topic, payload, received = self.messages.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                self.lag_last = time.monotonic() - received
+                self.lag_max = max(self.lag_max, self.lag_last)
+                self.handle(topic, payload)
+                FEED_LAG_SECONDS.observe(time.monotonic() - received, topic)
+            if self.receiver is not None and self.receiver.reload_requested.is_set():
+                # deltas were dropped, the gap they left is not waited for
+                self.receiver.reload_requested.clear()
+                self.dynfw_list.reload_list('queue_full')
+            self.dynfw_list.idle()
+            if time.monotonic() - last_stats_time >= STATS_LOG_INTERVAL:
+                self.log_stats()
+                last_stats_time = time.monotonic()
+        self.dynfw_list.batcher.flush()
+        if self.dynfw_list.checkpoint is not None:
+            self.dynfw_list.save_checkpoint()
+
+    def handle(self, topic, payload):
+        try:
+            if topic == TOPIC_DYNFW_LIST:
+                self.dynfw_list.handle_list(payload)
+            elif topic == TOPIC_DYNFW_DELTA:
+                self.dynfw_list.handle_delta(payload)
+            else:
+                logger.warning("Unknown message topic: %s", topic)
+        except InvalidMsgError as e:
+            logger.warning("Invalid message received: %s", e)
+            PARSE_FAILURES.inc()
+
+    def log_stats(self):
+        logger.info("Message queue: depth %d/%d, lag %.3f s (max %.3f s)", self.messages.qsize(),
+                    self.messages.maxsize, self.lag_last, self.lag_max)
+        self.lag_max = self.lag_last
+        self.dynfw_list.log_stats()
+
+
+def create_parser():
     parser = argparse.ArgumentParser(description='Turris::Sentinel Dynamic Firewall Client')
     parser.add_argument('-s',
                         '--server',
@@ -336,11 +2832,136 @@ def parse_args():
     parser.add_argument('--ipset',
                         default="turris-sn-dynfw-block",
                         help='IPset name to push blocked IPs to')
+    parser.add_argument('--list-mode',
+                        choices=('reconcile', 'reload'),
+                        default='reconcile',
+                        help='How to apply a full LIST message: only the difference against the router '
+                             '(reconcile) or wipe everything and add the whole list again (reload)')
+    parser.add_argument('--bulk-load',
+                        choices=('off', 'api', 'ftp'),
+                        default=BULK_LOAD_DEFAULT,
+                        help='Add many missing addresses of a LIST by uploading a generated .rsc script (through '
+                             'the API or FTP) and running /import instead of one API add per address')
+    parser.add_argument('--batch-window',
+                        type=float,
+                        default=DELTA_BATCH_WINDOW_DEFAULT,
+                        help='Seconds to collect delta messages before sending them to the router at once '
+                             '(0 sends every delta immediately)')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=DELTA_BATCH_SIZE_DEFAULT,
+                        help='Send collected delta messages as soon as this many addresses are pending')
+    parser.add_argument('--write-mode',
+                        choices=('pipelined', 'sequential', 'adaptive'),
+                        default='pipelined',
+                        help='Send address-list commands back-to-back as tagged API sentences (pipelined), '
+                             'wait for the reply of each command before sending the next one (sequential) '
+                             'or pipeline as many as the router answers without slowing down (adaptive)')
+    parser.add_argument('--max-in-flight',
+                        type=int,
+                        default=MAX_IN_FLIGHT_DEFAULT,
+                        help='Maximum number of pipelined commands waiting for a reply')
+    parser.add_argument('--min-in-flight',
+                        type=int,
+                        default=MIN_IN_FLIGHT_DEFAULT,
+                        help='Lowest number of pipelined commands the adaptive write mode backs off to')
+    parser.add_argument('--cpu-limit',
+                        type=int,
+                        default=CPU_LIMIT_DEFAULT,
+                        help='Adaptive write mode slows down while the router CPU load is above this percentage, '
+                             'read from /system/resource every {} seconds (0 = ignore CPU load)'.format(CPU_POLL_INTERVAL))
+    parser.add_argument('--queue-size',
+                        type=int,
+                        default=QUEUE_SIZE_DEFAULT,
+                        help='Maximum number of received messages waiting to be written to the router')
+    parser.add_argument('--queue-policy',
+                        choices=('block', 'drop'),
+                        default=QUEUE_POLICY_DEFAULT,
+                        help='When the queue is full either wait for the router (block) or drop deltas and '
+                             'resynchronize from the full list (drop)')
+    parser.add_argument('--serial-window',
+                        type=int,
+                        default=MISSING_UPDATE_CNT_LIMIT,
+                        help='How many delta messages ahead of a missing serial are held until it arrives')
+    parser.add_argument('--gap-timeout',
+                        type=float,
+                        default=SERIAL_GAP_TIMEOUT_DEFAULT,
+                        help='Seconds to wait for a missing delta serial before reloading the whole list')
+    parser.add_argument('--checkpoint',
+                        default=CHECKPOINT_PATH_DEFAULT,
+                        help='File to save the applied state to for a fast restart (empty string disables it)')
+    parser.add_argument('--checkpoint-interval',
+                        type=float,
+                        default=CHECKPOINT_INTERVAL_DEFAULT,
+                        help='Seconds between checkpoint saves')
+    parser.add_argument('--aggregate-threshold',
+                        type=int,
+                        default=AGGREGATE_THRESHOLD_DEFAULT,
+                        help='Push a whole --aggregate-prefix block as one prefix entry once at least this many of '
+                             'its addresses are blocked (0 disables aggregation)')
+    parser.add_argument('--aggregate-prefix',
+                        type=int,
+                        choices=range(8, 32),
+                        default=AGGREGATE_PREFIX_DEFAULT,
+                        metavar='{8..31}',
+                        help='Prefix length of the aggregated blocks')
+    parser.add_argument('--entry-timeout',
+                        type=int,
+                        default=ENTRY_TIMEOUT_DEFAULT,
+                        help='Add address-list entries with this timeout in seconds and keep refreshing the ones '
+                             'still in the feed, unblocked addresses expire on the router (0 = permanent entries)')
+    parser.add_argument('--audit-interval',
+                        type=int,
+                        default=AUDIT_INTERVAL_DEFAULT,
+                        help='Compare the whole address-list with the router once per this many seconds, bucket by '
+                             'bucket in idle time, and repair the buckets that differ (0 = no audit)')
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        default=0,
+                        help='Serve Prometheus metrics on http://--metrics-address:PORT/metrics (0 disables)')
+    parser.add_argument('--metrics-address',
+                        default=METRICS_ADDRESS_DEFAULT,
+                        help='Address the metrics endpoint listens on')
+    parser.add_argument('--record',
+                        help='Write every received feed message to this file, to be replayed by '
+                             'benchmarks/feed_replay.py')
+    parser.add_argument('--devices',
+                        help='JSON file with the routers to push the feed to, a list of objects with '
+                             'name, host, port, username and password (overrides --router)')
+    parser.add_argument('--devices-db',
+                        help='Load the routers from the Machine table of the PMikrotik database (e.g. '
+                             'PMikrotik/app.db), machines without an IP address are skipped')
+    parser.add_argument('--router',
+                        default=ip4,
+                        help='MikroTik RouterOS API address')
+    parser.add_argument('--router-port',
+                        type=int,
+                        default=api_port,
+                        help='MikroTik RouterOS API port')
+    parser.add_argument('--router-user',
+                        default=username,
+                        help='MikroTik RouterOS API username')
+    parser.add_argument('--router-password',
+                        default=password,
+                        help='MikroTik RouterOS API password')
+    parser.add_argument('--router-sessions',
+                        type=int,
+                        default=ROUTER_SESSIONS_DEFAULT,
+                        help='Number of API sessions kept open to the router')
+    parser.add_argument('--writer-sessions',
+                        type=int,
+                        default=WRITER_SESSIONS_DEFAULT,
+                        help='Write address-list changes over this many API sessions at once, split by address '
+                             'so that the changes of one address stay in order (opens more sessions if needed)')
     parser.add_argument('-v',
                         '--verbose',
                         action="store_true",
                         help='Increase output verbosity')
-    return parser.parse_args()
+    return parser
+
+
+def parse_args():
+    return create_parser().parse_args()
 
 
 def configure_logging(debug: bool):
@@ -371,56 +2992,99 @@ def main():
 
     context = zmq.Context()
     socket = create_zmq_socket(context, args.cert)
+    socket.get_monitor_socket()  # before connecting, a local server (benchmarks/feed_replay.py) accepts at once
     socket.connect("tcp://{}:{}".format(args.server, args.port))
     wait_for_connection(socket)
 
-    # Create a connection to the RouterOS device
-    api_connection = routeros_api.RouterOsApiPool(ip4, username=username, password=password, port=8728,
-                                                  plaintext_login=True)
-    api = api_connection.get_api()
-
-    dynfw_list = DynfwList(socket, args.ipset, api)
+    max_in_flight = args.max_in_flight if args.write_mode != 'sequential' else 1
+    write_control = (args.min_in_flight, args.cpu_limit) if args.write_mode == 'adaptive' else None
+    devices = None
+    if args.devices:
+        devices = load_devices_file(args.devices)
+    elif args.devices_db:
+        try:
+            devices = load_devices_db(args.devices_db)
+        except sqlite3.OperationalError as e:
+            # database of an older PMikrotik without the API columns of machine
+            logger.critical("Can't read routers from %s: %s. Run flask db migrate and flask db upgrade in PMikrotik.",
+                            args.devices_db, e)
+            sys.exit(1)
 
-    server_addresses = []  # Initialize with an empty list
+    aggregate = (args.aggregate_prefix, args.aggregate_threshold) if args.aggregate_threshold > 0 else None
+    router = None
+    fanout = None
+    ipset = None
+    if devices:
+        # the same feed for every router, each one written from its own thread
+        fanout = ipset = DeviceFanout(args.ipset, devices, args.queue_size, max_in_flight, args.router_sessions,
+                                      aggregate, args.entry_timeout, args.bulk_load, write_control,
+                                      args.audit_interval, args.writer_sessions)
+        logger.info("Fanning dynfw feed out to %d routers", len(devices))
+    else:
+        # Long-lived connection(s) to the RouterOS device, shared by all address-list operations
+        router = RouterConnection(args.router, args.router_user, args.router_password, args.router_port,
+                                  sessions=max(args.router_sessions, args.writer_sessions))
+        if aggregate is not None:
+            ipset = AggregatedIpset(Ipset(args.ipset, router, max_in_flight=max_in_flight,
+                                          entry_timeout=args.entry_timeout, bulk_load=args.bulk_load,
+                                          write_control=write_control, audit_interval=args.audit_interval,
+                                          writer_sessions=args.writer_sessions), *aggregate)
+
+    checkpoint = None
+    if args.checkpoint and fanout is None:
+        # every router of a fan-out is reconciled on start anyway
+        checkpoint = Checkpoint(args.checkpoint, args.checkpoint_interval)
+
+    # receiving thread -> bounded queue -> router writing thread
+    messages = queue.Queue(maxsize=args.queue_size)
+    if args.metrics_port:
+        QUEUE_DEPTH.set_function(messages.qsize)
+        start_metrics_server(args.metrics_address, args.metrics_port)
+    recorder = FeedRecorder(args.record) if args.record else None
+    receiver = FeedReceiver(socket, messages, args.queue_policy, recorder)
+    dynfw_list = DynfwList(receiver, args.ipset, router, reconcile=args.list_mode == 'reconcile',
+                           batch_window=args.batch_window, batch_size=args.batch_size,
+                           max_in_flight=max_in_flight, ipset=ipset, serial_window=args.serial_window,
+                           gap_timeout=args.gap_timeout, checkpoint=checkpoint, entry_timeout=args.entry_timeout,
+                           bulk_load=args.bulk_load, write_control=write_control,
+                           audit_interval=args.audit_interval, writer_sessions=args.writer_sessions)
+    if checkpoint is not None:
+        dynfw_list.resume()
+    writer = RouterWriter(dynfw_list, messages, receiver)
+    if fanout is not None:
+        fanout.serial = dynfw_list.serial
+        fanout.start()
 
     # Set the maximum duration in seconds for update functions
     max_update_duration = 6000000000
 
     start_time = time.time()
 
-    # Create and register the poller object
-    poller = zmq.Poller()
-    poller.register(socket, zmq.POLLIN)
-
-    while True:
-        elapsed_time = time.time() - start_time
-
-        if elapsed_time >= max_update_duration:
-            print(f"Max update duration ({max_update_duration} seconds) reached. Exiting the loop.")
-            break
-
-        socks = dict(poller.poll(100000))  # Timeout in milliseconds
+    writer.start()
+    receiver.start()
+    try:
+        while receiver.is_alive() and writer.is_alive():
+            elapsed_time = time.time() - start_time
 
-        if socket in socks and socks[socket] == zmq.POLLIN:
-            try:
-                msg = socket.recv_multipart()
-                topic, payload = parse_msg(msg)
-                if topic == TOPIC_DYNFW_LIST:
-                    dynfw_list.handle_list(payload)
-                    server_addresses = payload.get('list', [])
-                elif topic == TOPIC_DYNFW_DELTA:
-                    dynfw_list.handle_delta(payload)
-                else:
-                    logger.warning("Unknown message topic: %s", topic)
+            if elapsed_time >= max_update_duration:
+                print(f"Max update duration ({max_update_duration} seconds) reached. Exiting the loop.")
+                break
 
-                # Update elapsed time only during the execution of update functions
-                elapsed_time = time.time() - start_time
-            except InvalidMsgError as e:
-                logger.warning("Invalid message received: %s", e)
-        else:
-            print("No message received within the timeout.")
+            writer.join(1)
+    except KeyboardInterrupt:
+        pass
 
     # ... (any additional cleanup or actions if needed)
+    receiver.stop()
+    writer.stop()
+    receiver.join()
+    writer.join()
+    if recorder is not None:
+        recorder.close()
+    if fanout is not None:
+        fanout.close()
+    else:
+        router.close()
 
 
 if __name__ == "__main__":
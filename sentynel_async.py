@@ -0,0 +1,624 @@
+import asyncio
+import logging
+import re
+import socket
+import sys
+import time
+import urllib.request
+import zmq
+import zmq.asyncio
+import routeros_api
+from routeros_api.base_api import encode_length
+from zmq.utils.monitor import parse_monitor_message
+
+import sentynel
+from sentynel import (
+    ingest_addresses,
+    int_to_ip,
+    InvalidMsgError,
+    LIST_RELOADS,
+    MESSAGES_RECEIVED,
+    PARSE_FAILURES,
+    parse_msg,
+    Serial,
+    MISSING_UPDATE_CNT_LIMIT,
+    REQUIRED_DELTA_KEYS,
+    REQUIRED_LIST_KEYS,
+    RE_IPV4,
+    STATS_LOG_INTERVAL,
+    TOPIC_DYNFW_DELTA,
+    TOPIC_DYNFW_LIST,
+    WriteController,
+)
+
+# asyncio varianta sentynel.py - jeden proces, zadna vlakna, libovolny pocet MikroTiku (--router a,b,c)
+
+logger = logging.getLogger("sentinel_dynfw_client")
+
+#jak dlouho (v sekundach) se ceka na spojeni a prihlaseni k RouterOS API
+ROUTER_CONNECT_TIMEOUT = 15
+#maximalni prodleva (v sekundach) mezi pokusy o znovupripojeni
+RECONNECT_DELAY_MAX = 120
+
+ROUTER_CONNECTION_ERRORS = sentynel.ROUTER_CONNECTION_ERRORS + (asyncio.TimeoutError, asyncio.IncompleteReadError)
+
+#volby sentynel.py, ktere asyncio klient neumi (kazdy router ma jedno spojeni, zmeny se vzdy porovnavaji s routerem)
+UNSUPPORTED_OPTIONS = ('--devices', '--devices-db', '--checkpoint', '--checkpoint-interval', '--entry-timeout',
+                       '--bulk-load', '--aggregate-threshold', '--aggregate-prefix', '--audit-interval', '--list-mode',
+                       '--queue-policy', '--router-sessions', '--writer-sessions')
+
+# ZMQ_EVENT_HANDSHAKE_FAILED_* - see sentynel.wait_for_connection
+HANDSHAKE_FAILED_EVENTS = (0x0800, 0x2000, 0x4000)
+
+
+async def renew_server_certificate(cert_url, cert_path):
+    logger.info("Renewing server certificate")
+    delay = 1
+    while True:
+        try:
+            data = await asyncio.to_thread(fetch_url, cert_url)
+            with open(cert_path, "wb") as filef:
+                filef.write(data)
+            logger.info("Server certificate renewed")
+            return
+        except urllib.error.URLError as exc:
+            delay = delay * 2 if delay < 120 else delay  # At maximum we wait for two minutes to try again
+            logger.warning("Unable to renew certificate (another try after %d sec): %s", delay, exc.reason)
+            await asyncio.sleep(delay)
+
+
+def fetch_url(url):
+    with urllib.request.urlopen(url) as urlf:
+        return urlf.read()
+
+
+async def wait_for_connection(socket):
+    # True when connected, False when the CURVE handshake failed
+    monitor = socket.get_monitor_socket()
+    logger.debug("waiting for connection")
+    try:
+        while True:
+            evt = parse_monitor_message(await monitor.recv_multipart())
+            if evt['event'] == zmq.EVENT_CONNECTED:
+                logger.debug("connected")
+                return True
+            if evt['event'] in HANDSHAKE_FAILED_EVENTS:
+                logger.error("Can't connect - handshake failed.")
+                return False
+    finally:
+        socket.disable_monitor()
+        monitor.close()
+
+
+class AsyncRouterOsApi:
+    # RouterOS API wire protocol on asyncio streams: length-prefixed words, sentences terminated by an empty word,
+    # every command tagged so that any number of them can wait for their reply at once.
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tag = 0
+        self.pending = {}
+        self.reader_task = None
+        self.broken = None
+
+    @classmethod
+    async def connect(cls, host, port, username, password, timeout=ROUTER_CONNECT_TIMEOUT):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        api = cls(reader, writer)
+        api.reader_task = asyncio.create_task(api._read_replies())
+        try:
+            await asyncio.wait_for(api.call('/login', {'name': username, 'password': password}), timeout)
+        except BaseException:
+            await api.close()
+            raise
+        return api
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        self.broken = routeros_api.exceptions.RouterOsApiConnectionClosedError("connection closed")
+        self._fail_pending(self.broken)
+
+    async def call(self, command, arguments=None, queries=None):
+        # returns (list of !re attribute dicts, attributes of !done)
+        return await (await self._send(command, arguments, queries))
+
+    async def stream(self, command, arguments=None, queries=None):
+        # the !re attribute dicts one by one as they arrive instead of all of them at !done
+        rows = asyncio.Queue()
+        future = await self._send(command, arguments, queries, rows)
+        while True:
+            row = await rows.get()
+            if row is None:
+                break
+            yield row
+        await future  # !trap or a lost connection
+
+    async def _send(self, command, arguments=None, queries=None, rows=None):
+        if self.broken is not None:
+            raise self.broken
+        self.tag += 1
+        tag = str(self.tag)
+        words = [command.encode()]
+        for key, value in (arguments or {}).items():
+            words.append(b'=' + key.encode() + b'=' + _to_bytes(value))
+        for key, value in (queries or {}).items():
+            words.append(b'?' + key.encode() + b'=' + _to_bytes(value))
+        words.append(b'.tag=' + tag.encode())
+        future = asyncio.get_running_loop().create_future()
+        self.pending[tag] = PendingCall(future, words, rows)
+        self.writer.write(b''.join(encode_length(len(word)) + word for word in words) + b'\x00')
+        await self.writer.drain()
+        return future
+
+    async def _read_word(self):
+        first = (await self.reader.readexactly(1))[0]
+        if first < 0x80:
+            return await self.reader.readexactly(first) if first else b''
+        if first < 0xC0:
+            extra, length = 1, first & 0x3F
+        elif first < 0xE0:
+            extra, length = 2, first & 0x1F
+        elif first < 0xF0:
+            extra, length = 3, first & 0x0F
+        elif first == 0xF0:
+            extra, length = 4, 0
+        else:
+            raise routeros_api.exceptions.FatalRouterOsApiError("Malformed length")
+        for byte in await self.reader.readexactly(extra):
+            length = (length << 8) | byte
+        return await self.reader.readexactly(length)
+
+    async def _read_sentence(self):
+        words = []
+        while True:
+            word = await self._read_word()
+            if not word:
+                return words
+            words.append(word)
+
+    async def _read_replies(self):
+        try:
+            while True:
+                sentence = await self._read_sentence()
+                if not sentence:
+                    continue
+                reply, tag, attributes = sentence[0], None, {}
+                for word in sentence[1:]:
+                    if word.startswith(b'.tag='):
+                        tag = word[5:].decode()
+                    elif word.startswith(b'='):
+                        key, _, value = word[1:].partition(b'=')
+                        attributes[key.decode()] = value.decode('utf-8', 'replace')
+                if reply == b'!fatal':
+                    raise routeros_api.exceptions.RouterOsApiFatalCommunicationError(
+                        "Fatal error: {}".format(b' '.join(sentence[1:]).decode('utf-8', 'replace')))
+                call = self.pending.get(tag)
+                if call is None:
+                    logger.warning("Reply for unknown tag %s", tag)
+                    continue
+                if reply == b'!re':
+                    call.reply(attributes)
+                elif reply == b'!trap':
+                    call.error = attributes.get('message', 'unknown error')
+                elif reply == b'!done':
+                    del self.pending[tag]
+                    call.finish(attributes)
+        except (asyncio.IncompleteReadError, OSError, routeros_api.exceptions.RouterOsApiError) as e:
+            self.broken = routeros_api.exceptions.RouterOsApiConnectionError(str(e))
+            self._fail_pending(self.broken)
+
+    def _fail_pending(self, exc):
+        pending, self.pending = self.pending, {}
+        for call in pending.values():
+            if not call.future.done():
+                call.future.set_exception(exc)
+            call.end()
+
+
+class PendingCall:
+    # rows: queue getting the !re replies as they arrive (None at the end), see AsyncRouterOsApi.stream
+    def __init__(self, future, words, rows=None):
+        self.future = future
+        self.words = words
+        self.replies = []
+        self.rows = rows
+        self.error = None
+
+    def reply(self, attributes):
+        if self.rows is not None:
+            self.rows.put_nowait(attributes)
+        else:
+            self.replies.append(attributes)
+
+    def end(self):
+        if self.rows is not None:
+            self.rows.put_nowait(None)
+
+    def finish(self, done_attributes):
+        self.end()
+        if self.future.done():
+            return
+        if self.error is not None:
+            self.future.set_exception(routeros_api.exceptions.RouterOsApiCommunicationError(
+                "Error \"{}\" executing command {}".format(self.error, b' '.join(self.words)),
+                self.error.encode()))
+        else:
+            self.future.set_result((self.replies, done_attributes))
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class AdaptiveSemaphore:
+    # semaphore whose size follows the adaptive limit of a WriteController
+    def __init__(self, controller):
+        self.controller = controller
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.controller.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+class AsyncRouter:
+    # One MikroTik: own connection, own queue of pending changes and own view of its address-list,
+    # so a slow or offline router never holds back the others.
+    def __init__(self, host, port, username, password, list_name, max_in_flight=sentynel.MAX_IN_FLIGHT_DEFAULT,
+                 queue_size=sentynel.QUEUE_SIZE_DEFAULT, batch_window=sentynel.DELTA_BATCH_WINDOW_DEFAULT,
+                 batch_size=sentynel.DELTA_BATCH_SIZE_DEFAULT, write_control=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.list_name = list_name
+        self.max_in_flight = max(1, max_in_flight)
+        # write_control = (min_in_flight, cpu_limit), see sentynel.Ipset
+        self.controller = None
+        if write_control is not None:
+            self.controller = WriteController(write_control[0], self.max_in_flight, write_control[1])
+            sentynel.WRITE_WINDOW.set_function(lambda: self.controller.limit, host, list_name)
+        self.batch_window = batch_window
+        self.batch_size = max(1, batch_size)
+        self.changes = asyncio.Queue(queue_size)
+        self.addresses = set()
+        self.ids = {}
+        self.needs_resync = True
+        self.api = None
+        self.written = 0
+
+    def push(self, ip, blocked):
+        if self.needs_resync:
+            return  # everything gets fixed by the resync
+        try:
+            self.changes.put_nowait((ip, blocked))
+        except asyncio.QueueFull:
+            logger.warning("%s: too many pending changes, will resynchronize the whole list", self.host)
+            self.request_resync()
+
+    def request_resync(self):
+        self.needs_resync = True
+        while not self.changes.empty():
+            self.changes.get_nowait()
+        self.changes.put_nowait(None)  # wake up the writer
+
+    async def run(self, dynfw_list):
+        delay = 1
+        while True:
+            try:
+                self.api = await AsyncRouterOsApi.connect(self.host, self.port, self.username, self.password)
+                logger.info("%s: connected to RouterOS API", self.host)
+                delay = 1
+                await self._write_changes(dynfw_list)
+            except* ROUTER_CONNECTION_ERRORS as group:
+                logger.warning("%s: RouterOS API connection failed (reconnect after %d sec): %s", self.host, delay,
+                               group.exceptions[0])
+            except* routeros_api.exceptions.RouterOsApiError as group:
+                # !trap outside a single command (login refused, resync print), only this router backs off
+                logger.error("%s: RouterOS API error (reconnect after %d sec): %s", self.host, delay,
+                             group.exceptions[0])
+            finally:
+                if self.api is not None:
+                    await self.api.close()
+                    self.api = None
+            self.needs_resync = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    async def _write_changes(self, dynfw_list):
+        while True:
+            if self.needs_resync:
+                await self.resync(dynfw_list.addresses)
+            batch = await self._next_batch()
+            if batch and not self.needs_resync:
+                await self._apply(batch)
+
+    async def _next_batch(self):
+        # wait for the first change, then collect more of them for batch_window seconds
+        batch = {}
+        change = await self.changes.get()
+        deadline = time.monotonic() + self.batch_window
+        while True:
+            if change is None:
+                return {}
+            batch[change[0]] = change[1]
+            if len(batch) >= self.batch_size:
+                return batch
+            try:
+                change = await asyncio.wait_for(self.changes.get(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return batch
+
+    async def resync(self, wanted):
+        self.needs_resync = False
+        self.ids = {}
+        async for entry in self.api.stream('/ip/firewall/address-list/print', {'.proplist': '.id,address'},
+                                           {'list': self.list_name}):
+            self.ids[entry['address']] = entry['.id']
+        self.addresses = set(self.ids)
+        wanted = set(wanted)
+        changes = {ip: False for ip in self.addresses - wanted}
+        changes.update((ip, True) for ip in wanted - self.addresses)
+        await self._apply(changes)
+        logger.info("%s: address-list %s synchronized, %d entries, %d changed", self.host, self.list_name,
+                    len(wanted), len(changes))
+
+    async def _apply(self, changes):
+        if self.controller is None:
+            semaphore = asyncio.Semaphore(self.max_in_flight)
+        else:
+            semaphore = AdaptiveSemaphore(self.controller)
+            await self._check_router_load()
+        async with asyncio.TaskGroup() as tasks:
+            for ip, blocked in changes.items():
+                if blocked and ip not in self.addresses:
+                    tasks.create_task(self._add(semaphore, ip))
+                elif not blocked and ip in self.addresses:
+                    tasks.create_task(self._remove(semaphore, ip))
+
+    async def _add(self, semaphore, ip):
+        async with semaphore:
+            sent, failed = time.monotonic(), False
+            try:
+                _, done = await self.api.call('/ip/firewall/address-list/add',
+                                              {'list': self.list_name, 'address': ip})
+                self.ids[ip] = done.get('ret')
+                self.addresses.add(ip)
+                self.written += 1
+            except routeros_api.exceptions.RouterOsApiCommunicationError as e:
+                failed = self._command_failed('add', ip, e)
+                if "failure: already have such entry" in str(e):
+                    self.addresses.add(ip)  # its .id is looked up when it is removed
+            self._observe(time.monotonic() - sent, failed)
+
+    async def _remove(self, semaphore, ip):
+        async with semaphore:
+            self.addresses.discard(ip)
+            sent, failed = time.monotonic(), False
+            try:
+                entry_id = self.ids.pop(ip, None)
+                if entry_id is None:
+                    entry_id = await self._entry_id(ip)
+                if entry_id is None:
+                    logger.warning("%s: address not found in the list: %s", self.host, ip)
+                    return
+                await self.api.call('/ip/firewall/address-list/remove', {'.id': entry_id})
+                self.written += 1
+            except routeros_api.exceptions.RouterOsApiCommunicationError as e:
+                failed = self._command_failed('remove', ip, e)
+            self._observe(time.monotonic() - sent, failed)
+
+    async def _entry_id(self, ip):
+        # not added by us (it was there already) - ask the router for this single entry, see Ipset._entry_id
+        replies, _ = await self.api.call('/ip/firewall/address-list/print', {'.proplist': '.id'},
+                                         {'list': self.list_name, 'address': ip})
+        return replies[0]['.id'] if replies else None
+
+    def _observe(self, latency, failed):
+        if self.controller is not None:
+            self.controller.observe(latency, failed)
+
+    async def _check_router_load(self):
+        if not self.controller.cpu_due():
+            return
+        try:
+            replies, _ = await self.api.call('/system/resource/print', {'.proplist': 'cpu-load'})
+            self.controller.cpu_observed(int(replies[0]['cpu-load']))
+        except (routeros_api.exceptions.RouterOsApiCommunicationError, IndexError, KeyError, ValueError) as e:
+            self.controller.cpu_checked = time.monotonic()
+            logger.debug("%s: can't read CPU load: %s", self.host, e)
+
+    def _command_failed(self, action, ip, e):
+        # True for errors other than the entry being there already / missing
+        if "failure: already have such entry" in str(e):
+            logger.warning("%s: address already exists in the list: %s", self.host, ip)
+        elif "failure: entry not found" in str(e) or "no such item" in str(e):
+            logger.warning("%s: address not found in the list: %s", self.host, ip)
+        else:
+            logger.error("%s: error modifying address list (%s %s): %s", self.host, action, ip, e)
+            return True
+        return False
+
+
+class AsyncDynfwList:
+    # The feed side: serial tracking and the authoritative set of blocked addresses, fanned out to all routers
+    def __init__(self, socket, routers, serial_window=MISSING_UPDATE_CNT_LIMIT,
+                 gap_timeout=sentynel.SERIAL_GAP_TIMEOUT_DEFAULT):
+        self.socket = socket
+        self.routers = routers
+        self.serial = Serial(serial_window, gap_timeout)
+        self.regexp = re.compile(RE_IPV4)
+        self.addresses = set()
+        self.socket.setsockopt(zmq.SUBSCRIBE, TOPIC_DYNFW_LIST.encode('utf-8'))
+
+    def handle_delta(self, msg):
+        for key in REQUIRED_DELTA_KEYS:
+            if key not in msg:
+                raise InvalidMsgError("missing delta key {}".format(key))
+        ready = self.serial.push(msg["serial"], msg)
+        if ready is None:
+            logger.warning("Serial %d out of the window after %d, reloading the list", msg["serial"],
+                           self.serial.current_serial)
+            self.reload_list('window')
+            return
+        for delta in ready:
+            self.apply_delta(delta)
+
+    def apply_delta(self, msg):
+        ip = msg["ip"]
+        if not isinstance(ip, str) or not self.regexp.fullmatch(ip):
+            logger.warning("IP address skipped as it is not IPv4: %s", ip)
+            return
+        blocked = msg["delta"] == "positive"
+        if blocked:
+            self.addresses.add(ip)
+        else:
+            self.addresses.discard(ip)
+        for router in self.routers:
+            router.push(ip, blocked)
+        logger.debug("DELTA message: %s%s, serial %d", "+" if blocked else "-", ip, msg["serial"])
+
+    def handle_list(self, msg):
+        for key in REQUIRED_LIST_KEYS:
+            if key not in msg:
+                raise InvalidMsgError("missing list key {}".format(key))
+        following = self.serial.reset(msg["serial"])  # deltas held while waiting for the list
+        report = ingest_addresses(msg["list"])
+        self.addresses = set(map(int_to_ip, report.addresses))
+        for router in self.routers:
+            router.request_resync()
+        logger.debug("LIST message - %s addresses (%d unique, %d rejected), serial %d", report.received,
+                     len(report.addresses), report.rejected, msg["serial"])
+        self.socket.setsockopt(zmq.UNSUBSCRIBE, TOPIC_DYNFW_LIST.encode('utf-8'))
+        self.socket.setsockopt(zmq.SUBSCRIBE, TOPIC_DYNFW_DELTA.encode('utf-8'))
+        for delta in following:
+            self.apply_delta(delta)
+
+    def reload_list(self, reason):
+        # deltas stay subscribed and are held until the LIST arrives
+        self.serial.request_reload()
+        LIST_RELOADS.inc(reason)
+        self.socket.setsockopt(zmq.SUBSCRIBE, TOPIC_DYNFW_LIST.encode('utf-8'))
+
+    def idle(self):
+        if self.serial.gap_expired():
+            logger.warning("Delta serial %d missing for %d s, reloading the list", self.serial.current_serial + 1,
+                           self.serial.gap_timeout)
+            self.reload_list('gap')
+
+
+async def receive_messages(socket, dynfw_list, recorder=None):
+    while True:
+        if await socket.poll(sentynel.WRITER_IDLE_TIMEOUT):
+            data = await socket.recv_multipart()
+            if recorder is not None:
+                recorder.write(data)
+            try:
+                topic, payload = parse_msg(data)
+                MESSAGES_RECEIVED.inc(topic)
+                if topic == TOPIC_DYNFW_LIST:
+                    dynfw_list.handle_list(payload)
+                elif topic == TOPIC_DYNFW_DELTA:
+                    dynfw_list.handle_delta(payload)
+                else:
+                    logger.warning("Unknown message topic: %s", topic)
+            except InvalidMsgError as e:
+                logger.warning("Invalid message received: %s", e)
+                PARSE_FAILURES.inc()
+        dynfw_list.idle()
+
+
+async def log_stats(dynfw_list):
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        for router in dynfw_list.routers:
+            logger.info("%s: %s, %d pending changes, %d router writes", router.host,
+                        "connected" if router.api is not None else "disconnected", router.changes.qsize(),
+                        router.written)
+            if router.controller is not None:
+                logger.info("%s: %d commands in flight (%d-%d), %.0f commands/s, CPU load %s%%", router.host,
+                            router.controller.limit, router.controller.minimum, router.controller.maximum,
+                            router.controller.rate(),
+                            router.controller.cpu_load if router.controller.cpu_load is not None else '-')
+
+
+async def connect_feed(context, args):
+    # connect to the dynfw server, renewing the certificate when the handshake fails
+    while True:
+        socket = sentynel.create_zmq_socket(context, args.cert)
+        socket.get_monitor_socket()  # before connecting, a local server accepts at once
+        socket.connect("tcp://{}:{}".format(args.server, args.port))
+        if await wait_for_connection(socket):
+            return socket
+        socket.close(linger=0)
+        if not args.renew:
+            print("Can't connect - handshake failed.", file=sys.stderr)
+            sys.exit(1)
+        await renew_server_certificate(args.cert_url, args.cert)
+
+
+async def run(args):
+    if args.renew:
+        await renew_server_certificate(args.cert_url, args.cert)
+
+    context = zmq.asyncio.Context()
+    socket = await connect_feed(context, args)
+
+    max_in_flight = args.max_in_flight if args.write_mode != 'sequential' else 1
+    write_control = (args.min_in_flight, args.cpu_limit) if args.write_mode == 'adaptive' else None
+    routers = [AsyncRouter(host, args.router_port, args.router_user, args.router_password, args.ipset,
+                           max_in_flight, args.queue_size, args.batch_window, args.batch_size, write_control)
+               for host in args.router.split(',')]
+    dynfw_list = AsyncDynfwList(socket, routers, args.serial_window, args.gap_timeout)
+    if args.metrics_port:
+        sentynel.QUEUE_DEPTH.set_function(lambda: sum(router.changes.qsize() for router in routers))
+        sentynel.start_metrics_server(args.metrics_address, args.metrics_port)
+
+    recorder = sentynel.FeedRecorder(args.record) if args.record else None
+    try:
+        async with asyncio.TaskGroup() as tasks:
+            for router in routers:
+                tasks.create_task(router.run(dynfw_list))
+            tasks.create_task(receive_messages(socket, dynfw_list, recorder))
+            tasks.create_task(log_stats(dynfw_list))
+    finally:
+        if recorder is not None:
+            recorder.close()
+
+
+def parse_args():
+    # the options of sentynel.py, the ones changed from their default must be supported here
+    parser = sentynel.create_parser()
+    args = parser.parse_args()
+    for option in UNSUPPORTED_OPTIONS:
+        dest = option[2:].replace('-', '_')
+        if getattr(args, dest) != parser.get_default(dest):
+            parser.error("{} is not supported by the asyncio client".format(option))
+    return args
+
+
+def main():
+    args = parse_args()
+    sentynel.configure_logging(args.verbose)
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import os
+import queue
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+
+import sentynel
+from fake_routeros import FakeRouterOs
+
+LIST = 'turris-sn-dynfw-block'
+
+
+@pytest.fixture
+def server():
+    server = FakeRouterOs().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def router(server):
+    return sentynel.RouterConnection('127.0.0.1', 'admin', 'admin', server.port)
+
+
+def router_entries(server):
+    return sorted(entry.address for entry in server.state.entries.values())
+
+
+def test_aggregated_block_split_on_removal_above_threshold(server, router):
+    aggregated = sentynel.AggregatedIpset(sentynel.Ipset(LIST, router), 24, 4)
+    for i in range(1, 6):
+        aggregated.add_ip('2.2.2.%d' % i)
+    aggregated.commit()
+    assert router_entries(server) == ['2.2.2.0/24']
+
+    aggregated.del_ip('2.2.2.1')
+    aggregated.commit()
+    assert router_entries(server) == ['2.2.2.2', '2.2.2.3', '2.2.2.4', '2.2.2.5']
+
+    # not aggregated again until the next LIST
+    aggregated.add_ip('2.2.2.9')
+    aggregated.commit()
+    assert router_entries(server) == ['2.2.2.2', '2.2.2.3', '2.2.2.4', '2.2.2.5', '2.2.2.9']
+
+    aggregated.reconcile(aggregated.get_addresses())
+    assert router_entries(server) == ['2.2.2.0/24']
+
+
+@pytest.mark.parametrize('ip', ['+10.2.3.4', ' 10.2.3.4', '10.2.3.4\n', '1_0.2.3.4', '10.2.3', '10.2.3.256', '', None])
+def test_ip_to_int_rejects_malformed(ip):
+    with pytest.raises(ValueError):
+        sentynel.ip_to_int(ip)
+
+
+def test_ip_to_int():
+    assert sentynel.ip_to_int('10.2.3.4') == 0x0A020304
+    assert sentynel.ip_to_int('010.2.3.4') == 0x0A020304
+
+
+def test_packed_address_set_rejects_malformed():
+    addresses = sentynel.PackedAddressSet()
+    with pytest.raises(ValueError):
+        addresses.add('xx')
+    with pytest.raises(ValueError):
+        addresses.add('+10.2.3.4')
+    addresses.add('10.2.3.4')
+    assert ' 10.2.3.4' not in addresses
+    assert 'xx' not in addresses
+    addresses.discard('xx')
+    assert list(addresses) == [0x0A020304]
+
+
+@pytest.mark.parametrize('use_numpy', [False, True])
+def test_ingest_accepts_only_strings(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(sentynel, 'numpy', None)
+    elif sentynel.numpy is None:
+        pytest.skip('NumPy is not installed')
+    report = sentynel.ingest_addresses(['10.0.0.2', 1, True, b'10.0.0.3', None, '10.0.0.1', '10.0.0.2'])
+    assert list(report.addresses) == [0x0A000001, 0x0A000002]
+    assert report.rejected == 4
+
+
+class FakeSocket:
+    def setsockopt(self, option, value):
+        pass
+
+
+def test_aggregated_resume_skips_listing_the_router(server, router, tmp_path):
+    checkpoint = sentynel.Checkpoint(str(tmp_path / 'dynfw.checkpoint'))
+    addresses = ['2.2.2.%d' % i for i in range(1, 6)] + ['8.8.8.8']
+    dynfw_list = sentynel.DynfwList(FakeSocket(), LIST, router, batch_window=0, checkpoint=checkpoint,
+                                    ipset=sentynel.AggregatedIpset(sentynel.Ipset(LIST, router), 24, 4))
+    dynfw_list.handle_list({'serial': 1, 'list': addresses})
+    dynfw_list.save_checkpoint()
+    assert router_entries(server) == ['2.2.2.0/24', '8.8.8.8']
+
+    aggregated = sentynel.AggregatedIpset(sentynel.Ipset(LIST, router), 24, 4)
+    dynfw_list = sentynel.DynfwList(FakeSocket(), LIST, router, batch_window=0, checkpoint=checkpoint,
+                                    ipset=aggregated)
+    assert dynfw_list.resume()
+    assert aggregated.ipset.index_verified
+    prints = server.state.calls['/ip/firewall/address-list/print']
+    dynfw_list.handle_list({'serial': 2, 'list': addresses + ['9.9.9.9']})
+    assert server.state.calls['/ip/firewall/address-list/print'] == prints
+    assert not aggregated.index_verified
+    assert router_entries(server) == ['2.2.2.0/24', '8.8.8.8', '9.9.9.9']
+
+
+def test_dropped_deltas_reload_the_list_once(router):
+    messages = queue.Queue(1)
+    receiver = sentynel.FeedReceiver(FakeSocket(), messages, policy='drop')
+    dynfw_list = sentynel.DynfwList(receiver, LIST, router, batch_window=0, gap_timeout=0.1)
+    dynfw_list.handle_list({'serial': 1, 'list': ['1.1.1.1']})
+    for serial in range(2, 6):
+        delta = {'serial': serial, 'delta': 'positive', 'ip': '1.1.1.%d' % serial}
+        receiver._enqueue((sentynel.TOPIC_DYNFW_DELTA, delta, time.monotonic()))
+    assert receiver.dropped == 3
+
+    writer = sentynel.RouterWriter(dynfw_list, messages, receiver)
+    writer.start()
+    deadline = time.monotonic() + 5
+    while (receiver.reload_requested.is_set() or not messages.empty()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.3)  # longer than gap_timeout
+    writer.stop()
+    writer.join()
+    assert dynfw_list.reloads == 1
+    assert not dynfw_list.serial.synchronized
+
+
+@pytest.mark.parametrize('internals', [True, False])
+def test_stream_print(server, router, monkeypatch, internals):
+    with server.state.lock:
+        server.state.add(LIST, '1.2.3.4')
+        server.state.add(LIST, '1.2.3.5')
+        server.state.add('other', '1.2.3.6')
+    with router.session() as api:
+        if not internals:
+            monkeypatch.delattr(api.communicator, 'exception_aware_communicator')
+        rows = list(sentynel.stream_print(api, '/ip/firewall/address-list', b'.id,address', {'list': LIST.encode()}))
+        assert [row['address'] for row in rows] == [b'1.2.3.4', b'1.2.3.5']
+        assert all(set(row) == {'id', 'address'} for row in rows)
+
+
+@pytest.mark.parametrize('error', [ConnectionResetError('reset'),
+                                   sentynel.routeros_api.exceptions.RouterOsApiConnectionError('closed')])
+def test_commit_keeps_requeued_commands_when_the_connection_drops(router, monkeypatch, error):
+    ipset = sentynel.Ipset(LIST, router)
+    ipset.add_ip('1.2.3.4')
+    address = sentynel.ip_to_int('1.2.3.5')
+
+    def send():
+        ipset.requeued.append(sentynel.OP_TOUCH, address)
+        raise error
+
+    monkeypatch.setattr(ipset, '_send', send)
+    assert not ipset.commit()
+    assert len(ipset.commands) == 1
+    assert ipset.retries.entries[address][0] == sentynel.OP_TOUCH